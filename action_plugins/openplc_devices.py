@@ -0,0 +1,139 @@
+"""File: openplc_devices.py
+
+Plugin for reconciling the whole OpenPLCv3 Slave Devices table at once.
+
+The listing is fetched once, details only for devices whose desired
+properties could differ from what the listing shows, and only the needed
+add/edit/delete requests are made. With purge, devices not in the list are
+removed.
+
+The requests, profiling and fingerprints are those of openplc_device, whose
+ActionModule this one extends with the bulk args and _loop().
+"""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+# Common error handlers
+from ansible.errors import AnsibleError
+# The single device ActionModule, loaded like Ansible loads it
+from ansible.plugins.loader import action_loader
+
+#### Device specific variables  ####
+NAME = 'device_name'
+ADD = 'add-modbus-device'
+EDIT = 'modbus-edit-device'
+INFO = 'modbus'
+ITEMS = 'devices'
+REQUIRED = [ITEMS]
+VALID_STATES = ['present', 'absent']
+PROPERTIES = 'properties'
+ADD_REQUIRED_PROPERTIES = ['device_name', 'device_id']  # Maybe more
+ID_COLUMN = 0
+# Properties shown in the listing, with their column.
+LISTED_PROPERTIES = {'device_protocol': 1}
+# Concurrent details fetches.
+WORKERS = 8
+#####################################
+
+
+class ActionModule(action_loader.get('openplc_device', class_only=True)):
+    # Control behaviour.
+    TRANSFERS_FILES = False
+
+    ###########################################################################
+    ### THE FOLLOWING FUNCTIONS ARE DUPLICATES OF OTHER BULK ActionModules. ###
+    ### DO NOT MODIFY OR MODIFY ALL OF THEM.                                ###
+    ### Currently exactly used in:                                          ###
+    ### - openplc_devices.py                                                ###
+    ### - openplc_users.py                                                  ###
+    ###########################################################################
+    def parse_args(self, required=REQUIRED, valid_states=VALID_STATES):
+        """Check whether the item list is specified (and valid)."""
+        for r in required:
+            assert r in self.args, f"No {r} specified."
+        for item in self.args[ITEMS]:
+            assert NAME in item, f"No {NAME} specified for {item}."
+            state = item.get('state', 'present')
+            assert state in valid_states, f'State "{state}" not in {valid_states}.'
+
+    def _could_differ(self, desired, cells):
+        """Return whether the listing row cannot prove desired is up to date."""
+        for p, value in desired.get(PROPERTIES, {}).items():
+            if p == NAME and str(value) == desired[NAME]:
+                continue
+            if p not in LISTED_PROPERTIES or \
+                    cells[LISTED_PROPERTIES[p]] != str(value):
+                return True
+        return False
+
+    def _loop(self, changed=False):
+        """Reconcile all items, returning whether something changed."""
+        info = self._check_info(self._get_table(INFO), INFO)
+        for row in info['malformed']:
+            print(f"Skipping malformed row {row['row']} on {INFO}: {row['html']}")
+        known = {row['cells'][ID_COLUMN]: row for row in info['rows']
+                 if len(row['cells']) > ID_COLUMN}
+        desired = self.args[ITEMS]
+        report = dict(added=[], modified=[], removed=[], unchanged=[])
+
+        # Details only for items the listing cannot confirm, fetched in
+        # parallel unless openplc_facts has them already.
+        compare = [d for d in desired if d[NAME] in known and
+                   d.get('state', 'present') == 'present' and
+                   self._could_differ(d, known[d[NAME]]['cells'])]
+        pages = [f"{EDIT}?table_id={known[d[NAME]]['id']}" for d in compare]
+        self.session.prefetch([p for p in pages if p not in self.facts],
+                              workers=self.args.get('workers', WORKERS))
+        # Read all details before the first write, which empties the page
+        # cache and drops the facts.
+        details = {d[NAME]: self._details(known[d[NAME]]['id']) for d in compare}
+
+        for d in desired:
+            item = d[NAME]
+            state = d.get('state', 'present')
+            if item in known:
+                row = known[item]
+                if state == 'absent':
+                    self._remove(row['id'])
+                    report['removed'].append(item)
+                elif item in details:
+                    # _modify() reads the desired properties from the args.
+                    self.args[PROPERTIES] = d.get(PROPERTIES, {})
+                    if self._modify(item, details[item]):
+                        report['modified'].append(item)
+                    else:
+                        report['unchanged'].append(item)
+                else:
+                    report['unchanged'].append(item)
+            elif state == 'present':
+                self._add_unverified(item, d.get(PROPERTIES, {}))
+                report['added'].append(item)
+
+        if self.args.get('purge', False):
+            listed = {d[NAME] for d in desired}
+            for item, row in known.items():
+                if item not in listed:
+                    self._remove(row['id'])
+                    report['removed'].append(item)
+
+        # One listing to check all added items.
+        if report['added']:
+            new_items = self._get_known()
+            missing = [item for item in report['added'] if item not in new_items]
+            if missing:
+                raise AnsibleError(f"{missing} not in {new_items}")
+        self.result[ITEMS] = report
+        return any(report[k] for k in ['added', 'modified', 'removed'])
+
+    def _add_unverified(self, item, properties, page=ADD):
+        """Add an item, _loop() checks all additions at once afterwards."""
+        data = dict(properties)
+        data[NAME] = item
+        for required in ADD_REQUIRED_PROPERTIES:
+            assert required in data, f"Missing {required} property for {item}."
+        print(f'Creating {data}')
+        self._post(page, data=data)
+    ###########################################################################
+    ### END DUPLICATES OF OTHER BULK CLASSES                                ###
+    ###########################################################################
@@ -0,0 +1,192 @@
+"""File: openplc_facts.py
+
+Plugin taking a snapshot of all OpenPLCv3 state, once per play.
+
+Fetches the users, slave devices, settings, hardware and programs pages and
+the edit page of every user and device concurrently over one session, and
+publishes them parsed as the openplc_state fact. The other openplc_* modules
+use the pages in the fact instead of fetching them again, until they change
+something themselves.
+"""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import cProfile
+import os
+import time
+# Common error handlers
+from ansible.errors import AnsibleError
+# ADT base class for our Ansible Action Plugin
+from ansible.plugins.action import ActionBase
+# Client side of the persistent openplc connection
+from ansible.module_utils.connection import Connection
+
+#### Facts specific variables  ####
+CONNECTION = 'openplc'
+FACT = 'openplc_state'
+# Listing page -> (edit page of its rows, column with the item name).
+LISTINGS = {'users': ('edit-user', 1), 'modbus': ('modbus-edit-device', 0),
+            'programs?list_all=1': (None, 0)}
+FORMS = ['settings', 'hardware']
+WORKERS = 8
+# Seconds the snapshot is used by the other modules.
+MAX_AGE = 3600
+#####################################
+
+
+class ActionModule(ActionBase):
+    # Control behaviour.
+    TRANSFERS_FILES = False
+
+    ###########################################################################
+    ### THE FOLLOWING FUNCTIONS ARE DUPLICATES OF OTHER ActionModules.      ###
+    ### DO NOT MODIFY OR MODIFY ALL OF THEM.                                ###
+    ### Only the session handling of openplc_device.py is used here.        ###
+    ###########################################################################
+    def run(self, tmp=None, task_vars=None):
+        """Change openplc item, under cProfile when profiling is on.
+
+        Args:
+            tmp (str, optional): temporary directory. Defaults to None.
+            task_vars (dict, optional): host/group/config vars. Defaults to None.
+
+        Returns:
+            dict: Ansible return dict.
+        """
+        self.profile = self._profile_path(task_vars or {})
+        if self.profile is None:
+            return self._run(tmp=tmp, task_vars=task_vars)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(self._run, tmp=tmp, task_vars=task_vars)
+        finally:
+            profiler.dump_stats(self.profile + '.pstats')
+            print(f'Profile written to {self.profile}.pstats')
+
+    def _profile_path(self, task_vars, env='OPENPLC_PROFILE', var='openplc_profile'):
+        """Return the profile file of this task without extension, or None.
+
+        Profiling is on when the environment variable or the host or task
+        variable names a directory. Files are named <host>-<task>-<time>.
+        """
+        directory = os.environ.get(env) or task_vars.get(var)
+        if not directory:
+            return None
+        os.makedirs(directory, exist_ok=True)
+        name = f"{task_vars.get('inventory_hostname', 'localhost')}-{self._task.get_name()}"
+        name = ''.join(c if c.isalnum() or c in '-.' else '_' for c in name)
+        # Absolute, ansible-connection may run in another directory.
+        return os.path.join(os.path.abspath(directory), f"{name}-{time.strftime('%Y%m%d%H%M%S')}")
+
+    def _run(self, tmp=None, task_vars=None):
+        """Change openplc item, see run()."""
+        self._init(tmp=tmp, task_vars=task_vars)
+        try:
+            changed = self._loop()
+            # Requests of this task plus the timings measured by the module.
+            stats = dict(self.session.stats(), **self.stats)
+            return dict(changed=changed, openplc_cache=self.session.cache_stats(),
+                        openplc_stats=stats, **self.result)
+        finally:
+            self.stop_session()
+
+    def _init(self, tmp, task_vars):
+        """Initialise class."""
+        super(ActionModule, self).run(tmp, task_vars)
+        self.args = self._task.args.copy()
+        self.vars = task_vars
+        # Extra entries for the Ansible return dict and for openplc_stats.
+        self.result = dict()
+        self.stats = dict()
+        # Pages parsed by openplc_facts earlier in the play, until they expire.
+        facts = task_vars.get(FACT) or {}
+        self.facts = dict(facts.get('pages', {})) \
+            if facts.get('expires', 0) > time.time() else {}
+        self.parse_args()
+        self.start_session()
+
+    def _check_info(self, info, url, succes=200, error_len=300):
+        """Validate a response."""
+        if info['status_code'] != succes:
+            raise AnsibleError(
+                f'Status code for {url} not {succes}; {info["text"]}')
+        if 'error' and 'database' in info['text'][-error_len:].lower():
+            raise AnsibleError(info['text'][-error_len:], url)
+        return info
+
+    def start_session(self):
+        """Setup TCP session with PLC.
+
+        With ansible_connection=openplc the persistent connection is reused,
+        so the login happens once per host per play. Otherwise a connection
+        is created for this task only.
+        """
+        print('Setting up connection... ', end='')
+        socket_path = getattr(self._connection, 'socket_path', None)
+        if self._connection.transport == CONNECTION and socket_path:
+            self.session = Connection(socket_path)
+            self.persistent = True
+        else:
+            self.session = self._shared_loader_obj.connection_loader.get(
+                CONNECTION, self._play_context, '/dev/null')
+            self.session.set_options(var_options=self.vars)
+            self.persistent = False
+        # Pages cached by earlier tasks may be stale by now.
+        self.session.clear_cache()
+        self.session.reset_stats()
+        # A persistent connection works in its own process, profile it too.
+        if self.profile and self.persistent:
+            self.session.start_profile()
+        print('done.')
+
+    def stop_session(self):
+        """Close a task-only connection, persistent ones stay alive."""
+        if not self.persistent:
+            self.session.close()
+        elif self.profile:
+            self.session.stop_profile(self.profile + '-connection.pstats')
+
+    ###########################################################################
+    ### END DUPLICATES OF OTHER CLASSES                                     ###
+    ###########################################################################
+
+    def parse_args(self):
+        """Check whether the args are valid."""
+        for arg in ['workers', 'max_age']:
+            if arg in self.args:
+                assert int(self.args[arg]) > 0, f"{arg} must be positive."
+        self.args.setdefault('details', True)
+
+    def _loop(self, changed=False):
+        """Take the snapshot, returning False as nothing changes."""
+        workers = int(self.args.get('workers', WORKERS))
+        # All listings and forms at once, the parsing then hits the cache.
+        self.session.prefetch(list(LISTINGS) + FORMS, workers=workers)
+        pages, items = {}, {}
+        for page, (edit, column) in LISTINGS.items():
+            info = self._check_info(self.session.get_table(page), page)
+            pages[page] = dict(rows=info['rows'], malformed=info['malformed'])
+            items[page] = {row['cells'][column]: row['id'] for row in info['rows']
+                           if len(row['cells']) > column}
+        for page in FORMS:
+            pages[page] = dict(form=self._check_info(
+                self.session.get_form(page), page)['form'])
+
+        # Edit pages of every user and device.
+        details = [f'{edit}?table_id={row["id"]}'
+                   for page, (edit, _) in LISTINGS.items() if edit is not None
+                   for row in pages[page]['rows']] if self.args['details'] else []
+        statuses = self.session.prefetch(details, workers=workers)
+        for page in details:
+            if statuses[page] != 200:
+                raise AnsibleError(f'Status code for {page} not 200')
+            pages[page] = dict(form=self.session.get_form(page)['form'])
+
+        taken = time.time()
+        self.result['ansible_facts'] = {FACT: dict(
+            taken=taken, expires=taken + int(self.args.get('max_age', MAX_AGE)),
+            users=items['users'], devices=items['modbus'],
+            programs=items['programs?list_all=1'], pages=pages)}
+        print(f'Snapshot of {len(pages)} pages')
+        return changed
@@ -5,13 +5,20 @@ Plugin for adding/removing/modifying OpenPLCv3 Slave Devices.
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
+import cProfile
+import hashlib
+import json
+import os
 import re
+import shlex
+import shutil
 import subprocess
+import tempfile
 import time
-import requests
 
 from ansible.plugins.action import ActionBase
 from ansible.errors import AnsibleError
+from ansible.module_utils.connection import Connection
 
 #### Device specific variables  ####
 STOP_PLC = 'stop_plc'
@@ -20,7 +27,8 @@ UPLOAD = 'upload-program'
 UPLOAD_WITH_INFO = 'upload-program-action'
 COMPIL_LOGS = 'compilation-logs'
 COMPILE = 'compile-program?file='
-LOGIN = "login"
+CONNECTION = 'openplc'
+FACT = 'openplc_state'
 INFO = 'programs?list_all=1'
 ADD = 'upload-program'
 REMOVE = 'remove-program?id='
@@ -28,9 +36,118 @@ SRC = '/src/webserver/st_files/'
 ADD_ACTION = 'upload-program-action'
 REQUIRED = ['name', 'file', 'state']
 VALID_STATES = ['present', 'absent']
+# Compilation log polling: seconds to wait first, growth factor and cap.
+POLL_START = 0.1
+POLL_FACTOR = 2
+POLL_MAX = 2
+COMPILE_TIMEOUT = 300
+COMPILED = re.compile("Compilation finished successfully!")
+COMPILE_ERROR = re.compile("error(s) found. Bailing out!")
+COMPILE_ERRORS = re.compile("Compilation finished with errors!")
+# Runtime state after start_plc, polled like the compilation logs.
+DASHBOARD = 'dashboard'
+RUNNING = re.compile("Running")
+START_TIMEOUT = 60
+# Programs uploaded with stage: true, activated by a later task.
+STAGED = 'staged'
+STAGED_TTL = 7 * 24 * 3600
+# Local cache of program digests, keyed by path, size and modification time.
+DIGESTS = 'digests'
+DIGEST_TTL = 30 * 24 * 3600
+DIGEST_CHUNK = 1 << 20
+# Local syntax check of programs before upload, results cached by digest.
+CHECKS = 'st_checks'
+IEC2C = 'iec2c'
+IEC2C_TIMEOUT = 60
+ST_BLOCKS = {'PROGRAM': 'END_PROGRAM', 'FUNCTION': 'END_FUNCTION',
+             'FUNCTION_BLOCK': 'END_FUNCTION_BLOCK', 'VAR': 'END_VAR',
+             'VAR_INPUT': 'END_VAR', 'VAR_OUTPUT': 'END_VAR',
+             'VAR_IN_OUT': 'END_VAR', 'VAR_GLOBAL': 'END_VAR',
+             'VAR_EXTERNAL': 'END_VAR', 'VAR_TEMP': 'END_VAR',
+             'VAR_ACCESS': 'END_VAR', 'VAR_CONFIG': 'END_VAR',
+             'IF': 'END_IF', 'CASE': 'END_CASE', 'FOR': 'END_FOR',
+             'WHILE': 'END_WHILE', 'REPEAT': 'END_REPEAT',
+             'TYPE': 'END_TYPE', 'STRUCT': 'END_STRUCT',
+             'CONFIGURATION': 'END_CONFIGURATION', 'RESOURCE': 'END_RESOURCE',
+             'STEP': 'END_STEP', 'INITIAL_STEP': 'END_STEP',
+             'TRANSITION': 'END_TRANSITION', 'ACTION': 'END_ACTION'}
+ST_TOKENS = re.compile(r"\(\*|\*\)|//[^\n]*|'(?:\$.|[^'$])*'|\"(?:\$.|[^\"$])*\""
+                       r"|['\"]|[A-Za-z_][A-Za-z0-9_]*|[()]|\n")
+ST_COMMENT = re.compile(r"\(\*|\*\)|\n")
+ST_ENDS = set(ST_BLOCKS.values())
+# Shared ssh master connection for file operations outside Ansible's connection.
+SSH_CONTROL_PATH = '~/.ansible/cp/openplc-%C'
+SSH_CONTROL_PERSIST = '60s'
+# Seconds ssh waits for the PLC host, it never prompts for a password.
+SSH_CONNECT_TIMEOUT = 10
+# Characters of already seen log text that are scanned again, so a message
+# split over two polls is still found.
+LOG_OVERLAP = 64
 #####################################
 
 
+def st_errors(text, blocks=ST_BLOCKS):
+    """Return the structure errors of an IEC 61131-3 structured text program.
+
+    Not a full parser: checks comments, strings, parentheses and that every
+    block (PROGRAM, VAR, IF, ...) is closed by its END_ keyword, which is
+    what most broken uploads get wrong.
+    """
+    errors, stack, programs = [], [], 0
+    parens, line, comment, pos = 0, 1, 0, 0
+    while True:
+        # Inside a comment only comment delimiters count, they nest in matiec.
+        match = (ST_COMMENT if comment else ST_TOKENS).search(text, pos)
+        if match is None:
+            break
+        pos, token = match.end(), match.group()
+        word = token.upper()
+        line += token.count('\n')
+        if token == '(*':
+            comment += 1
+        elif token == '*)':
+            if not comment:
+                errors.append(f'line {line}: *) outside a comment')
+            comment = max(0, comment - 1)
+        elif comment or token == '\n' or token.startswith('//') or len(token) > 1 \
+                and token[0] in '\'"':
+            continue
+        elif token in ("'", '"'):
+            errors.append(f'line {line}: unterminated string')
+        elif token == '(':
+            parens += 1
+        elif token == ')':
+            parens -= 1
+            if parens < 0:
+                errors.append(f'line {line}: unbalanced )')
+                parens = 0
+        elif word == 'PROGRAM' and stack and stack[-1][0] in ('END_RESOURCE',
+                                                               'END_CONFIGURATION'):
+            # PROGRAM instance WITH task : name; of a resource, no block.
+            continue
+        elif word in blocks:
+            stack.append((blocks[word], token, line))
+        elif word in ST_ENDS:
+            if stack and stack[-1][0] == word:
+                stack.pop()
+                programs += word == 'END_PROGRAM'
+                continue
+            expected = f'{stack[-1][0]} for {stack[-1][1]} on line {stack[-1][2]}' \
+                if stack else 'no block to end'
+            errors.append(f'line {line}: {token}, expected {expected}')
+            if any(end == word for end, _, _ in stack):
+                while stack.pop()[0] != word:
+                    pass
+    if comment:
+        errors.append('unterminated comment')
+    if parens:
+        errors.append(f'{parens} unclosed (')
+    errors += [f'line {line}: {token} without {end}' for end, token, line in stack]
+    if not programs and not errors:
+        errors.append('no PROGRAM ... END_PROGRAM')
+    return errors
+
+
 class ActionModule(ActionBase):
     # Control behaviour.
     TRANSFERS_FILES = False
@@ -38,7 +155,7 @@ class ActionModule(ActionBase):
     ### THE FOLLOWING FUNCTIONS ARE DUPLICATES OF OTHER ActionModules.      ###
     ### DO NOT MODIFY OR MODIFY ALL OF THEM.                                ###
     def run(self, tmp=None, task_vars=None):
-        """Change openplc item.
+        """Change openplc item, under cProfile when profiling is on.
 
         Args:
             tmp (str, optional): temporary directory. Defaults to None.
@@ -47,34 +164,160 @@ class ActionModule(ActionBase):
         Returns:
             dict: Ansible return dict.
         """
+        self.profile = self._profile_path(task_vars or {})
+        if self.profile is None:
+            return self._run(tmp=tmp, task_vars=task_vars)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(self._run, tmp=tmp, task_vars=task_vars)
+        finally:
+            profiler.dump_stats(self.profile + '.pstats')
+            print(f'Profile written to {self.profile}.pstats')
+
+    def _profile_path(self, task_vars, env='OPENPLC_PROFILE', var='openplc_profile'):
+        """Return the profile file of this task without extension, or None.
+
+        Profiling is on when the environment variable or the host or task
+        variable names a directory. Files are named <host>-<task>-<time>.
+        """
+        directory = os.environ.get(env) or task_vars.get(var)
+        if not directory:
+            return None
+        os.makedirs(directory, exist_ok=True)
+        name = f"{task_vars.get('inventory_hostname', 'localhost')}-{self._task.get_name()}"
+        name = ''.join(c if c.isalnum() or c in '-.' else '_' for c in name)
+        # Absolute, ansible-connection may run in another directory.
+        return os.path.join(os.path.abspath(directory), f"{name}-{time.strftime('%Y%m%d%H%M%S')}")
+
+    def _run(self, tmp=None, task_vars=None):
+        """Change openplc item, see run()."""
         self._init(tmp=tmp, task_vars=task_vars)
-        return dict(changed=self._loop())
+        try:
+            self._check_syntax()
+            if self._fingerprint_matches():
+                changed = False
+                # An unchanged program is still expected to run.
+                if self.args['state'] == 'present' and not self.args.get('stage'):
+                    self._get(START_PLC)
+            else:
+                changed = self._loop()
+            self._store_fingerprint(changed)
+            # Requests of this task plus the timings measured by the module.
+            stats = dict(self.session.stats(), **self.stats)
+            return dict(changed=changed, openplc_cache=self.session.cache_stats(),
+                        openplc_stats=stats, **self.result)
+        finally:
+            self.stop_session()
+
+    def _fingerprint_matches(self, cache='fingerprints', modes=('off', 'check', 'trust')):
+        """Return whether an earlier run already applied exactly these args.
+
+        A fingerprint is the digest of the args (and of the files they name)
+        of a task that ran before, with the digest of the listing page right
+        after it. In check mode a match costs one GET of the listing, in
+        trust mode no request at all. Off by default: listings do not show
+        every property (passwords, device addresses), so a change made
+        elsewhere is not corrected while a fingerprint matches.
+        """
+        mode = self.args.get('fingerprint', 'off')
+        if mode not in modes:
+            raise AnsibleError(f'Unknown fingerprint "{mode}", use one of {modes}')
+        self.digest = None if mode == 'off' else self._args_digest()
+        if self.digest is None:
+            return False
+        known = self.session.cache_get(cache, self._fingerprint_key()) or {}
+        if self.digest not in known or \
+                mode == 'check' and known[self.digest] != self._listing_digest():
+            return False
+        print(f'Fingerprint matches ({mode}), nothing to do.')
+        self.result['fingerprint'] = mode
+        return True
+
+    def _store_fingerprint(self, changed, cache='fingerprints', ttl=7 * 24 * 3600):
+        """Remember the args with the listing they resulted in.
+
+        A change may undo what other tasks on this page applied, so it
+        forgets their fingerprints.
+        """
+        if self.digest is None or self.result.get('fingerprint'):
+            return
+        key = self._fingerprint_key()
+        known = {} if changed else self.session.cache_get(cache, key) or {}
+        known[self.digest] = self._listing_digest()
+        self.session.cache_set(cache, key, known, ttl)
+
+    def _fingerprint_key(self):
+        """Return the fingerprint cache key of this PLC and listing page."""
+        host = self.vars.get('ansible_host', self.vars.get('inventory_hostname'))
+        return f"{host}:{self.vars.get('http_port')}:{INFO}"
+
+    def _args_digest(self):
+        """Return a digest of the args and the size and age of named files."""
+        args = {k: v for k, v in self.args.items() if k != 'fingerprint'}
+        sha = hashlib.sha256(json.dumps(args, sort_keys=True, default=str).encode())
+        values = list(args.values())
+        while values:
+            value = values.pop()
+            if isinstance(value, dict):
+                values += value.values()
+            elif isinstance(value, list):
+                values += value
+            elif isinstance(value, str) and os.path.isfile(value):
+                stat = os.stat(value)
+                sha.update(f'{value}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+        return sha.hexdigest()
+
+    def _listing_digest(self):
+        """Return the digest of the listing page."""
+        return hashlib.sha256(self._get(INFO)['text'].encode()).hexdigest()
 
     def _get(self, url):
         """Perform GET request."""
-        return self._check_info(self.session.get(url), url)
+        return self._check_info(self.session.request(url), url)
 
     def _post(self, url, data=None, files=None):
         """Perform POST request."""
-        return self._check_info(self.session.post(url, data=data, files=files), url)
+        self._drop_facts()
+        return self._check_info(
+            self.session.request(url, method='POST', data=data, files=files), url)
 
     def _check_info(self, info, url, succes=200, error_len=300):
         """Validate a response."""
         print(url)
-        if info.status_code != succes:
+        if info['status_code'] != succes:
             raise AnsibleError(
-                f'Status code for {url} not {succes}; {info.text}')
-        if 'error' and 'database' in info.text[-error_len:].lower():
-            raise AnsibleError(info.text[-error_len:], url)
+                f'Status code for {url} not {succes}; {info["text"]}')
+        if 'error' and 'database' in info['text'][-error_len:].lower():
+            raise AnsibleError(info['text'][-error_len:], url)
         return info
 
     def _get_known(self, column=1, page=INFO):
-        """Return first <td></td> entries on page with onclick ID."""
-        info = self._get(self.url + page)
-        # Return first td entry with value device_id in each table row (except header).
-        return {re.findall("<td>.*?</td>", row)[column][4:-5]:
-                re.search("table_id=.*?'", row).group()[9:-1] for row in
-                re.findall("<tr.*?>.*?</tr>", info.text, re.DOTALL)[1:]}
+        """Return <td></td> entries in column on page with their table ID."""
+        info = self._check_info(self._get_table(page), page)
+        for row in info['malformed']:
+            print(f"Skipping malformed row {row['row']} on {page}: {row['html']}")
+        # Rows (except header) as column entry -> table_id.
+        return {row['cells'][column]: row['id'] for row in info['rows']
+                if len(row['cells']) > column}
+
+    def _get_table(self, page):
+        """Return get_table() of page, from the openplc_state fact if it has it."""
+        info = self.facts.get(page)
+        if info is None or 'rows' not in info:
+            return self.session.get_table(page)
+        return dict(info, status_code=200, text='', url=page)
+
+    def _drop_facts(self, pages=(INFO,)):
+        """Stop using the openplc_state fact, this task changes the PLC.
+
+        Later tasks get the fact back without the pages of this module.
+        """
+        if self.facts:
+            self.facts = {}
+            fact = self.vars[FACT]
+            self.result['ansible_facts'] = {FACT: dict(fact, pages={
+                page: info for page, info in fact['pages'].items()
+                if not page.startswith(pages)})}
 
     def _modify(self, item_id, src=SRC, page_logs=COMPIL_LOGS):
         """Modify file properties when changed."""
@@ -85,18 +328,24 @@ class ActionModule(ActionBase):
         val_list = list(files.values())
         position = val_list.index(item_id)
 
-        stdin = subprocess.run(
-            [f'ssh {self.vars["ssh_user"]}@{self.vars["ansible_host"]} -p {self.vars["ssh_port"]} cat {src}{key_list[position]}'], capture_output=True, shell=True)
-        with open(self.args["file"], 'rb') as new_file:
-            new = str(new_file.read())
-            old = str(stdin.stdout)
-            if new == old:
-                self._get(self.url + START_PLC)
-                return False
-
-        info = self._get(self.url + "reload-program?table_id=" + item_id)
-
-        self.filename = re.search("(?P<n>[0-9]{2,6}.st)", info.text).group('n')
+        # Compare digests instead of pulling the whole remote file.
+        old = self._remote('sha256sum', src + key_list[position]).split(' ')[0]
+        if old == self._digest(self.args["file"]):
+            if not self.args.get('stage'):
+                self._get(START_PLC)
+            return False
+        if self.args.get('stage'):
+            return self._stage()
+        if self._staged():
+            # Compile the staged file as a new program, then drop the old one.
+            self._add(page_logs=page_logs)
+            self._start(self.stopped)
+            self._remove(item_id, src=src)
+            return True
+
+        info = self._get("reload-program?table_id=" + item_id)
+
+        self.filename = re.search("(?P<n>[0-9]{2,6}.st)", info['text']).group('n')
 
         payload = {
             'epoch_time': time.time(),
@@ -105,31 +354,17 @@ class ActionModule(ActionBase):
             'prog_file': self.filename,
         }
 
-        info2 = self._post(self.url + "update-program-action", data=payload)
-        info3 = self._get(self.url + "compile-program?file=" + self.filename)
-
-        while True:
-            time.sleep(2)
-            info_complilation = self._get(self.url + page_logs)
-            compiled = re.search(
-                "(Compilation finished successfully!)", info_complilation.text)
-            if compiled is not None:
-                break
-            error = re.search("error(s) found. Bailing out!",
-                              info_complilation.text)
-            error2 = re.search(
-                "Compilation finished with errors!", info_complilation.text)
-            if error2 is not None:
-                raise AnsibleError(f"Compilation finished with errors")
-            if error is not None:
-                raise AnsibleError(f"Error during compilation of the code")
+        start = time.monotonic()
+        info2 = self._post("update-program-action", data=payload)
+        info3 = self._get("compile-program?file=" + self.filename)
+        self._wait_compilation(start, page_logs=page_logs)
 
         existing_files = self._get_known()
         print(existing_files)
         if self.filename not in existing_files:
             raise AnsibleError(
-                f"{self.filename} not in {existing_files}, {info.text}")
-        self._get(self.url + START_PLC)
+                f"{self.filename} not in {existing_files}, {info['text']}")
+        self._start(start)
         return True
 
     def _remove(self, item_id, remove=REMOVE, src=SRC):
@@ -144,10 +379,10 @@ class ActionModule(ActionBase):
         val_list = list(files.values())
         position = val_list.index(item_id)
 
-        self._get(self.url + remove + str(item_id))
+        self._drop_facts()
+        self._get(remove + str(item_id))
 
-        subprocess.run([f'ssh {self.vars["ssh_user"]}@{self.vars["ansible_host"]} -p {self.vars["ssh_port"]} rm {src}{key_list[position]}'],
-                       capture_output=True, shell=True)
+        self._remote('rm', src + key_list[position])
         return True
 
     def _loop(self, changed=False):
@@ -166,7 +401,7 @@ class ActionModule(ActionBase):
                 raise AnsibleError(f'Unknown state "{state}"')
         else:
             if state == 'present':
-                changed = self._add()
+                changed = self._stage() if self.args.get('stage') else self._add()
             elif state == 'absent':
                 pass
             else:
@@ -174,13 +409,13 @@ class ActionModule(ActionBase):
         return changed
 
     def _add(self, page=ADD, page_action=ADD_ACTION, page_logs=COMPIL_LOGS):
-        """Add a file."""
-        # print("here")
-        files = [
-            ('file', (self.args["file"], open(self.args["file"], 'rb'), 'text'))]
-        info = self._post(self.url + page, files=files)
-
-        self.filename = re.search("(?P<n>[0-9]{2,6}.st)", info.text).group('n')
+        """Add a file, the one staged earlier if there is one."""
+        self.filename = self._staged()
+        if self.filename is None:
+            self.filename = self._upload(page)
+        else:
+            print(f'Activating staged {self.filename}')
+            self.session.cache_delete(STAGED, self._staged_key())
 
         payload = {
             'epoch_time': time.time(),
@@ -189,31 +424,210 @@ class ActionModule(ActionBase):
             'prog_file': self.filename,
         }
 
-        info2 = self._post(self.url + page_action, data=payload)
-
-        while True:
-            time.sleep(2)
-            info_complilation = self._get(self.url + page_logs)
-            compiled = re.search(
-                "Compilation finished successfully!", info_complilation.text)
-            if compiled is not None:
-                break
-            error = re.search("error(s) found. Bailing out!",
-                              info_complilation.text)
-            error2 = re.search(
-                "Compilation finished with errors!", info_complilation.text)
-            if error2 is not None:
-                raise AnsibleError(f"Compilation finished with errors")
-            if error is not None:
-                raise AnsibleError(f"Error during compilation of the code")
+        # Posting the program info starts the compilation, which stops the
+        # runtime.
+        start = self.stopped = time.monotonic()
+        info = self._post(page_action, data=payload)
+        self._wait_compilation(start, page_logs=page_logs)
 
         existing_files = self._get_known()
         print(existing_files)
         if self.filename not in existing_files:
             raise AnsibleError(
-                f"{self.filename} not in {existing_files}, {info.text}")
+                f"{self.filename} not in {existing_files}, {info['text']}")
         return True
 
+    def _upload(self, page=ADD):
+        """Upload the program file and return its name on the PLC.
+
+        Only stores the file, the runtime keeps running until the program
+        info is posted.
+        """
+        # The connection opens the file, it may not share our working dir.
+        files = {'file': [self.args["file"],
+                          os.path.abspath(self.args["file"]), 'text']}
+        info = self._post(page, files=files)
+        return re.search("(?P<n>[0-9]{2,6}.st)", info['text']).group('n')
+
+    def _stage(self, ttl=STAGED_TTL):
+        """Upload the program for a later activation, without compiling it.
+
+        OpenPLC stops the runtime for every compilation, so compiling waits
+        for the activation task and the program is verified locally by
+        _check_syntax() meanwhile. The activation then skips the upload.
+        """
+        if self._staged():
+            return False
+        filename = self._upload()
+        self.session.cache_set(STAGED, self._staged_key(), dict(
+            file=filename, digest=self._digest(self.args['file'])), ttl)
+        self.result['staged_file'] = filename
+        print(f'Staged {filename}')
+        return True
+
+    def _staged(self):
+        """Return the file staged for exactly this program, or None."""
+        staged = self.session.cache_get(STAGED, self._staged_key())
+        if staged and staged['digest'] == self._digest(self.args['file']):
+            return staged['file']
+        return None
+
+    def _staged_key(self):
+        """Return the staging cache key of this program on this PLC."""
+        host = self.vars.get('ansible_host', self.vars.get('inventory_hostname'))
+        return f"{host}:{self.vars.get('http_port')}:{self.args['name']}"
+
+    def _start(self, stopped, page=DASHBOARD, timeout=START_TIMEOUT):
+        """Start the runtime and report how long it was down.
+
+        Args:
+            stopped (float): time.monotonic() when the compilation, which
+                stops the runtime, started.
+        """
+        self._get(START_PLC)
+        interval = POLL_START
+        while RUNNING.search(self._get(page)['text']) is None:
+            if time.monotonic() - stopped > timeout:
+                raise AnsibleError(f"Runtime not running {timeout}s after start")
+            time.sleep(interval)
+            interval = min(interval * POLL_FACTOR, POLL_MAX)
+        self.result['downtime'] = round(time.monotonic() - stopped, 3)
+        self.stats['downtime'] = self.result['downtime']
+        print(f"Runtime down for {self.result['downtime']}s")
+
+    def _remote(self, *command, control_path=SSH_CONTROL_PATH):
+        """Run a command on the PLC host and return its stdout.
+
+        Uses the task's own SSH connection when it logs in as ssh_user on
+        ssh_port. Otherwise ssh shares a ControlMaster socket, so only the
+        first call in a while pays for the SSH handshake.
+        """
+        command = ' '.join(shlex.quote(c) for c in command)
+        user, port = self.vars['ssh_user'], int(self.vars['ssh_port'])
+        if self._connection.transport == 'ssh' and \
+                self._play_context.remote_user == user and \
+                int(self._play_context.port or 22) == port:
+            return self._low_level_execute_command(command)['stdout']
+        control_path = os.path.expanduser(control_path)
+        os.makedirs(os.path.dirname(control_path), mode=0o700, exist_ok=True)
+        ssh = ['ssh', '-o', 'BatchMode=yes',
+               '-o', f'ConnectTimeout={SSH_CONNECT_TIMEOUT}',
+               '-o', 'ControlMaster=auto',
+               '-o', f'ControlPath={control_path}',
+               '-o', f'ControlPersist={SSH_CONTROL_PERSIST}',
+               '-p', str(port), f"{user}@{self.vars['ansible_host']}", command]
+        return subprocess.run(ssh, capture_output=True).stdout.decode(
+            errors='replace')
+
+    def _digest(self, filename):
+        """Return the sha256 of a local file, cached while it is unchanged."""
+        stat = os.stat(filename)
+        key = f'{os.path.abspath(filename)}:{stat.st_size}:{stat.st_mtime_ns}'
+        digest = self.session.cache_get(DIGESTS, key)
+        if digest is None:
+            sha = hashlib.sha256()
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(DIGEST_CHUNK), b''):
+                    sha.update(chunk)
+            digest = sha.hexdigest()
+            self.session.cache_set(DIGESTS, key, digest, DIGEST_TTL)
+        return digest
+
+    def _check_syntax(self, cache=CHECKS, ttl=DIGEST_TTL):
+        """Reject a program with syntax errors before talking to the PLC.
+
+        Uses iec2c (the matiec compiler of OpenPLC) when it is on the PATH or
+        given as openplc_iec2c, the structure check of st_errors() otherwise
+        or when iec2c cannot judge the program. Results are cached by program
+        digest, so every program is checked once, not once per host.
+        """
+        if self.args['state'] != 'present' or not self.args.get('syntax_check', True):
+            return
+        start = time.monotonic()
+        digest = self._digest(self.args['file'])
+        iec2c = self.vars.get('openplc_iec2c') or shutil.which(IEC2C)
+        checker, errors = 'iec2c', None
+        if iec2c:
+            errors = self.session.cache_get(cache, f'{checker}:{digest}')
+            if errors is None:
+                errors = self._iec2c_errors(iec2c)
+                if errors is not None:
+                    self.session.cache_set(cache, f'{checker}:{digest}', errors, ttl)
+        if errors is None:
+            checker = 'parser'
+            errors = self.session.cache_get(cache, f'{checker}:{digest}')
+            if errors is None:
+                with open(self.args['file'], 'r', errors='replace') as f:
+                    errors = st_errors(f.read())
+                self.session.cache_set(cache, f'{checker}:{digest}', errors, ttl)
+        self.result['syntax_check'] = checker
+        self.stats['syntax_check'] = round(time.monotonic() - start, 3)
+        if errors:
+            raise AnsibleError(f"Syntax errors in {self.args['file']}:\n"
+                               + '\n'.join(errors))
+
+    def _iec2c_errors(self, iec2c, timeout=IEC2C_TIMEOUT):
+        """Return the errors iec2c reports for the program file.
+
+        Returns None when iec2c could not judge the program: it timed out,
+        did not run, or failed without pointing at the program (e.g. a
+        missing library directory). Such results are not cached.
+        """
+        program = os.path.abspath(self.args['file'])
+        command = [iec2c, '-f', '-l', '-p', '-r', '-R', '-a']
+        if self.vars.get('openplc_iec2c_include'):
+            command += ['-I', self.vars['openplc_iec2c_include']]
+        # iec2c writes the generated C next to where it runs.
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                process = subprocess.run(command + [program], cwd=directory,
+                                         capture_output=True, timeout=timeout)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            print(f'iec2c could not check {program}: {e}')
+            return None
+        if process.returncode == 0:
+            return []
+        output = (process.stdout + process.stderr).decode(errors='replace')
+        errors = [line for line in output.splitlines()
+                  if os.path.basename(program) in line]
+        if not errors:
+            print(f'iec2c exited with {process.returncode}: {output.strip()}')
+            return None
+        return errors
+
+    def _wait_compilation(self, start, page_logs=COMPIL_LOGS):
+        """Poll the compilation logs until the compilation finished.
+
+        Polls quickly at first and backs off up to POLL_MAX seconds. Only log
+        text not seen in earlier polls is scanned. The measured compilation
+        time is put in the result.
+
+        Args:
+            start (float): time.monotonic() when the compilation started.
+            page_logs (str, optional): log page. Defaults to COMPIL_LOGS.
+        """
+        timeout = float(self.args.get('compile_timeout', COMPILE_TIMEOUT))
+        interval, seen = POLL_START, 0
+        while True:
+            time.sleep(interval)
+            text = self._get(page_logs)['text']
+            # A shorter log belongs to a new compilation, scan all of it.
+            new = text[max(0, seen - LOG_OVERLAP):] if len(text) >= seen else text
+            seen = len(text)
+            if COMPILED.search(new) is not None:
+                break
+            if COMPILE_ERRORS.search(new) is not None:
+                raise AnsibleError(f"Compilation finished with errors")
+            if COMPILE_ERROR.search(new) is not None:
+                raise AnsibleError(f"Error during compilation of the code")
+            elapsed = time.monotonic() - start
+            if elapsed > timeout:
+                raise AnsibleError(f"Compilation not finished after {elapsed:.0f}s")
+            interval = min(interval * POLL_FACTOR, POLL_MAX)
+        self.result['compile_time'] = round(time.monotonic() - start, 3)
+        self.stats['compile_wait'] = self.result['compile_time']
+        print(f"Compiled in {self.result['compile_time']}s")
+
     def parse_args(self, required=REQUIRED, valid_states=VALID_STATES):
         """Check whether required args are specified (and valid)."""
         for r in required:
@@ -221,20 +635,42 @@ class ActionModule(ActionBase):
         state = self.args['state']
         assert state in valid_states, f'State "{state}" not in {valid_states}.'
 
-    def start_session(self, login=LOGIN):
-        """Setup TCP session with PLC."""
-        ip, port = self.vars['ansible_host'], self.vars['http_port']
-        self.url = f'http://{ip}:{port}/'
-        user, password = self.vars['username'], self.vars['password']
-        payload = {"username": user, "password": password}
-
-        self.session = requests.session()
-        self._post(self.url + login, data=payload)
+    def start_session(self, connection=CONNECTION):
+        """Setup TCP session with PLC, reusing a persistent connection."""
+        socket_path = getattr(self._connection, 'socket_path', None)
+        if self._connection.transport == connection and socket_path:
+            self.session = Connection(socket_path)
+            self.persistent = True
+        else:
+            self.session = self._shared_loader_obj.connection_loader.get(
+                connection, self._play_context, '/dev/null')
+            self.session.set_options(var_options=self.vars)
+            self.persistent = False
+        # Pages cached by earlier tasks may be stale by now.
+        self.session.clear_cache()
+        self.session.reset_stats()
+        # A persistent connection works in its own process, profile it too.
+        if self.profile and self.persistent:
+            self.session.start_profile()
+
+    def stop_session(self):
+        """Close a task-only connection, persistent ones stay alive."""
+        if not self.persistent:
+            self.session.close()
+        elif self.profile:
+            self.session.stop_profile(self.profile + '-connection.pstats')
 
     def _init(self, tmp, task_vars):
         """Initialise class."""
         super(ActionModule, self).run(tmp, task_vars)
         self.args = self._task.args.copy()
         self.vars = task_vars
+        # Extra entries for the Ansible return dict and for openplc_stats.
+        self.result = dict()
+        self.stats = dict()
+        # Pages parsed by openplc_facts earlier in the play, until they expire.
+        facts = task_vars.get(FACT) or {}
+        self.facts = dict(facts.get('pages', {})) \
+            if facts.get('expires', 0) > time.time() else {}
         self.parse_args()
         self.start_session()
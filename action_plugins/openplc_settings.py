@@ -6,12 +6,17 @@ Plugin for adding/removing/modifying OpenPLCv3 users.
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
-import requests
-import re
+import cProfile
+import hashlib
+import json
+import os
+import time
 # Common error handlers
 from ansible.errors import AnsibleError
 # ADT base class for our Ansible Action Plugin
 from ansible.plugins.action import ActionBase
+# Client side of the persistent openplc connection
+from ansible.module_utils.connection import Connection
 
 
 #### User specific variables  ####
@@ -20,7 +25,8 @@ NAME = 'state'
 ADD = 'settings'
 EDIT = 'settings'
 RM = ''
-LOGIN = 'login'
+CONNECTION = 'openplc'
+FACT = 'openplc_state'
 INFO = 'settings'
 REQUIRED = ['state', 'properties']
 VALID_STATES = ['present']
@@ -46,9 +52,10 @@ class ActionModule(ActionBase):
     ### Currently partly used in:                                           ###
     ### - openplc_settings.py                                               ###
     ### - openplc_hardware.py                                               ###
+    ### - openplc_facts.py                                                  ###
     ###########################################################################
     def run(self, tmp=None, task_vars=None):
-        """Change openplc item.
+        """Change openplc item, under cProfile when profiling is on.
 
         Args:
             tmp (str, optional): temporary directory. Defaults to None.
@@ -57,14 +64,118 @@ class ActionModule(ActionBase):
         Returns:
             dict: Ansible return dict.
         """
+        self.profile = self._profile_path(task_vars or {})
+        if self.profile is None:
+            return self._run(tmp=tmp, task_vars=task_vars)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(self._run, tmp=tmp, task_vars=task_vars)
+        finally:
+            profiler.dump_stats(self.profile + '.pstats')
+            print(f'Profile written to {self.profile}.pstats')
+
+    def _profile_path(self, task_vars, env='OPENPLC_PROFILE', var='openplc_profile'):
+        """Return the profile file of this task without extension, or None.
+
+        Profiling is on when the environment variable or the host or task
+        variable names a directory. Files are named <host>-<task>-<time>.
+        """
+        directory = os.environ.get(env) or task_vars.get(var)
+        if not directory:
+            return None
+        os.makedirs(directory, exist_ok=True)
+        name = f"{task_vars.get('inventory_hostname', 'localhost')}-{self._task.get_name()}"
+        name = ''.join(c if c.isalnum() or c in '-.' else '_' for c in name)
+        # Absolute, ansible-connection may run in another directory.
+        return os.path.join(os.path.abspath(directory), f"{name}-{time.strftime('%Y%m%d%H%M%S')}")
+
+    def _run(self, tmp=None, task_vars=None):
+        """Change openplc item, see run()."""
         self._init(tmp=tmp, task_vars=task_vars)
-        return dict(changed=self._loop())
+        try:
+            changed = False if self._fingerprint_matches() else self._loop()
+            self._store_fingerprint(changed)
+            # Requests of this task plus the timings measured by the module.
+            stats = dict(self.session.stats(), **self.stats)
+            return dict(changed=changed, openplc_cache=self.session.cache_stats(),
+                        openplc_stats=stats, **self.result)
+        finally:
+            self.stop_session()
+
+    def _fingerprint_matches(self, cache='fingerprints', modes=('off', 'check', 'trust')):
+        """Return whether an earlier run already applied exactly these args.
+
+        A fingerprint is the digest of the args (and of the files they name)
+        of a task that ran before, with the digest of the listing page right
+        after it. In check mode a match costs one GET of the listing, in
+        trust mode no request at all. Off by default: listings do not show
+        every property (passwords, device addresses), so a change made
+        elsewhere is not corrected while a fingerprint matches.
+        """
+        mode = self.args.get('fingerprint', 'off')
+        if mode not in modes:
+            raise AnsibleError(f'Unknown fingerprint "{mode}", use one of {modes}')
+        self.digest = None if mode == 'off' else self._args_digest()
+        if self.digest is None:
+            return False
+        known = self.session.cache_get(cache, self._fingerprint_key()) or {}
+        if self.digest not in known or \
+                mode == 'check' and known[self.digest] != self._listing_digest():
+            return False
+        print(f'Fingerprint matches ({mode}), nothing to do.')
+        self.result['fingerprint'] = mode
+        return True
+
+    def _store_fingerprint(self, changed, cache='fingerprints', ttl=7 * 24 * 3600):
+        """Remember the args with the listing they resulted in.
+
+        A change may undo what other tasks on this page applied, so it
+        forgets their fingerprints.
+        """
+        if self.digest is None or self.result.get('fingerprint'):
+            return
+        key = self._fingerprint_key()
+        known = {} if changed else self.session.cache_get(cache, key) or {}
+        known[self.digest] = self._listing_digest()
+        self.session.cache_set(cache, key, known, ttl)
+
+    def _fingerprint_key(self):
+        """Return the fingerprint cache key of this PLC and listing page."""
+        host = self.vars.get('ansible_host', self.vars.get('inventory_hostname'))
+        return f"{host}:{self.vars.get('http_port')}:{INFO}"
+
+    def _args_digest(self):
+        """Return a digest of the args and the size and age of named files."""
+        args = {k: v for k, v in self.args.items() if k != 'fingerprint'}
+        sha = hashlib.sha256(json.dumps(args, sort_keys=True, default=str).encode())
+        values = list(args.values())
+        while values:
+            value = values.pop()
+            if isinstance(value, dict):
+                values += value.values()
+            elif isinstance(value, list):
+                values += value
+            elif isinstance(value, str) and os.path.isfile(value):
+                stat = os.stat(value)
+                sha.update(f'{value}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+        return sha.hexdigest()
+
+    def _listing_digest(self):
+        """Return the digest of the listing page."""
+        return hashlib.sha256(self._get(INFO)['text'].encode()).hexdigest()
 
     def _init(self, tmp, task_vars):
         """Initialise class."""
         super(ActionModule, self).run(tmp, task_vars)
         self.args = self._task.args.copy()
         self.vars = task_vars
+        # Extra entries for the Ansible return dict and for openplc_stats.
+        self.result = dict()
+        self.stats = dict()
+        # Pages parsed by openplc_facts earlier in the play, until they expire.
+        facts = task_vars.get(FACT) or {}
+        self.facts = dict(facts.get('pages', {})) \
+            if facts.get('expires', 0) > time.time() else {}
         self.parse_args()
         self.start_session()
 
@@ -99,45 +210,96 @@ class ActionModule(ActionBase):
 
     def _check_info(self, info, url, succes=200, error_len=300):
         """Validate a response."""
-        if info.status_code != succes:
+        if info['status_code'] != succes:
             raise AnsibleError(
-                f'Status code for {url} not {succes}; {info.text}')
-        if 'error' and 'database' in info.text[-error_len:].lower():
-            raise AnsibleError(info.text[-error_len:], url)
+                f'Status code for {url} not {succes}; {info["text"]}')
+        if 'error' and 'database' in info['text'][-error_len:].lower():
+            raise AnsibleError(info['text'][-error_len:], url)
         return info
 
     def _get(self, url):
         """Perform GET request."""
-        return self._check_info(self.session.get(url), url)
+        return self._check_info(self.session.request(url), url)
 
     def _post(self, url, data, files=None, file_key='file'):
         """Perform POST request."""
+        self._drop_facts()
         if file_key in data and data[file_key]:
             filename = data[file_key]
             extension = filename.split('.')[-1]
-            with open(filename, 'rb') as f:
-                files = {'file': (filename, f.read(), f'image/{extension}')}
+            # The connection opens the file, it may not share our working dir.
+            files = {'file': [filename, os.path.abspath(filename),
+                              f'image/{extension}']}
             del data[file_key]
-        return self._check_info(self.session.post(url, data=data, files=files), url)
+        return self._check_info(
+            self.session.request(url, method='POST', data=data, files=files), url)
+
+    def _get_table(self, page):
+        """Return get_table() of page, from the openplc_state fact if it has it."""
+        info = self.facts.get(page)
+        if info is None or 'rows' not in info:
+            return self.session.get_table(page)
+        return dict(info, status_code=200, text='', url=page)
+
+    def _get_form(self, page):
+        """Return get_form() of page, from the openplc_state fact if it has it."""
+        info = self.facts.get(page)
+        if info is None or 'form' not in info:
+            return self.session.get_form(page)
+        return dict(info, status_code=200, text='', url=page)
+
+    def _drop_facts(self, pages=(INFO, EDIT)):
+        """Stop using the openplc_state fact, this task changes the PLC.
+
+        Later tasks get the fact back without the pages of this module.
+        """
+        if self.facts:
+            self.facts = {}
+            fact = self.vars[FACT]
+            self.result['ansible_facts'] = {FACT: dict(fact, pages={
+                page: info for page, info in fact['pages'].items()
+                if not page.startswith(pages)})}
 
     def start_session(self):
-        """Setup TCP session with PLC."""
+        """Setup TCP session with PLC.
+
+        With ansible_connection=openplc the persistent connection is reused,
+        so the login happens once per host per play. Otherwise a connection
+        is created for this task only.
+        """
         print('Setting up connection... ', end='')
-        ip, port = self.vars['ansible_host'], self.vars['http_port']
-        self.url = f'http://{ip}:{port}/'
-        payload = {"username": self.vars['username'],
-                   "password": self.vars['password']}
-        self.session = requests.session()
-        self._post(self.url + LOGIN, data=payload)
+        socket_path = getattr(self._connection, 'socket_path', None)
+        if self._connection.transport == CONNECTION and socket_path:
+            self.session = Connection(socket_path)
+            self.persistent = True
+        else:
+            self.session = self._shared_loader_obj.connection_loader.get(
+                CONNECTION, self._play_context, '/dev/null')
+            self.session.set_options(var_options=self.vars)
+            self.persistent = False
+        # Pages cached by earlier tasks may be stale by now.
+        self.session.clear_cache()
+        self.session.reset_stats()
+        # A persistent connection works in its own process, profile it too.
+        if self.profile and self.persistent:
+            self.session.start_profile()
         print('done.')
 
+    def stop_session(self):
+        """Close a task-only connection, persistent ones stay alive."""
+        if not self.persistent:
+            self.session.close()
+        elif self.profile:
+            self.session.stop_profile(self.profile + '-connection.pstats')
+
     def _get_known(self, page=INFO, column=ID_COLUMN):
-        """Return first <td></td> entries on page with onclick ID."""
-        info = self._get(self.url + page)
-        # Return first td entry with value device_id in each table row (except header).
-        return {re.findall("<td>.*?</td>", row)[column][4:-5]:
-                re.search("table_id=.*?'", row).group()[9:-1] for row in
-                re.findall("<tr.*?>.*?</tr>", info.text, re.DOTALL)[1:]}
+        """Return <td></td> entries in column on page with their table ID."""
+        info = self._check_info(self._get_table(page), page)
+        for row in info['malformed']:
+            print(f"Skipping malformed row {row['row']} on {page}: {row['html']}")
+        # Rows (except header) as column entry -> table_id.
+        return {row['cells'][column]: row['id'] for row in info['rows']
+                if len(row['cells']) > column}
 
     def _details(self, item_table_id, page=EDIT):
         """Return all info for item.
@@ -146,31 +308,17 @@ class ActionModule(ActionBase):
         """
         if item_table_id is not None:
             page += '?table_id=' + str(item_table_id)
-        info = self._get(self.url + page)
-        properties = dict()
-
-        # Properties from bottom of page.
-        bottom = re.search(";devid.value.*?;}", info.text, re.DOTALL)
-        if bottom is not None:
-            for p in bottom.group().split(';'):
-                if '=' in p:
-                    attr, val = p.split(' = ')
-                    properties[attr[:-6].replace('dev', 'device_').replace(
-                        'start', '_start').replace('size', '_size')] = val[1:-1]
-
-        # Properties from input values.
-        for r in re.findall('<input .*?>', info.text, re.DOTALL):
-            name = re.findall("name='.*?'", r)
-            value = re.findall("value='.*?'", r)
-            if value and name:
-                properties[name[0][6:-1]] = value[0][7:-1]
+        info = self._check_info(self._get_form(page), page)
+        # Keep the whole form, some ActionModules need more than properties.
+        self.form = form = info['form']
+        # Properties from bottom of page, input values and textareas.
+        properties = {**form['script'], **form['inputs'], **form['textareas']}
 
         # Device type dropdown.
         if SELECTED_ITEM:
-            properties[SELECTED_ITEM] = re.findall("value='.*?'",
-                                                   re.findall("selected='selected'.*?>",
-                                                              info.text,
-                                                              re.DOTALL)[0])[0][7:-1]
+            selected = form['selected']
+            properties[SELECTED_ITEM] = selected.get(
+                SELECTED_ITEM, list(selected.values())[0])
         # Other.
         for m in MISSING_ENTRIES:
             properties[m] = ''
@@ -186,10 +334,10 @@ class ActionModule(ActionBase):
     #         assert required in data, f"Missing {required} property."
     #     print('TODO Maybe sanitise properties')
     #     print(f'Creating {data}')
-    #     info = self._post(self.url + page, data=data)
+    #     info = self._post(page, data=data)
     #     new_items = self._get_known()
     #     if item not in new_items:
-    #         raise AnsibleError(f"{item} not in {new_items}, {info.text}")
+    #         raise AnsibleError(f"{item} not in {new_items}, {info['text']}")
     #     return True
 
     def _remove(self, item_id, page=RM):
@@ -198,7 +346,8 @@ class ActionModule(ActionBase):
         E.g. calling http://145.100.108.22:8002/delete-device?dev_id=9
         """
         print(f'Removing {ITEM} {item_id}, not checking any properties!')
-        self._get(self.url + page + str(item_id))
+        self._drop_facts()
+        self._get(page + str(item_id))
         return True
 
     def _modify(self, device, device_details, page=EDIT):
@@ -215,7 +364,7 @@ class ActionModule(ActionBase):
                     device_details[p] = value
                     changed = True
         if changed:
-            self._post(self.url + page, data=device_details)
+            self._post(page, data=device_details)
         return changed
     ###########################################################################
     ### END DUPLICATES OF OTHER CLASSES                                     ###
@@ -229,11 +378,9 @@ class ActionModule(ActionBase):
         """
         assert PROPERTIES in self.args, 'Missing properties'
         details = self._details(None)
-        checked = [[name for name in details.keys()
-                    if re.findall('id=".*?"', r)[0][4:-1] in name][0]
-                   for r in re.findall('<input .*?>',
-                                       self._get(self.url + page).text, re.DOTALL)
-                   if 'checked' in r]
+        # Enabled settings have a checked checkbox, the same GET as details.
+        checked = [[name for name in details.keys() if input_id in name][0]
+                   for input_id in self.form['checked']]
         print('Checked', checked)
         current_details = {k: details[k]
                            for k in ADD_REQUIRED_PROPERTIES + checked}
@@ -259,5 +406,5 @@ class ActionModule(ActionBase):
                     current_details[p] = value
                     changed = True
         if changed:
-            self._post(self.url + page, data=current_details)
+            self._post(page, data=current_details)
         return changed
@@ -0,0 +1,218 @@
+"""File: analyse.py
+
+Statistics and regression gating for the results of measure.py.
+
+Reads the SQLite store of measure.py (see results.py), JSON lines and the
+older pickles (playbook -> list of seconds, -1 for a failed run). Samples
+are grouped by playbook and PLC state (running or not), failures are
+counted instead of averaged in, and every group gets its median, p90, p99
+and a bootstrap confidence interval of the median. Percentiles of all
+groups are computed at once on one NaN padded NumPy matrix, the bootstrap
+per group in bounded chunks. Without --run or --commit only the latest run
+of a store is analysed.
+
+    python analyse.py measurements.sqlite --commit 1b6135d --save-baseline baseline.json
+    python analyse.py measurements.sqlite --run <run id> --baseline baseline.json
+
+Exits 1 when a group is slower than the baseline beyond the threshold.
+"""
+import argparse
+import json
+import pickle
+import sys
+import warnings
+from collections import defaultdict
+
+import numpy as np
+
+from results import ResultStore
+
+PERCENTILES = [50, 90, 99]
+BOOTSTRAP = 2000
+CONFIDENCE = 0.95
+# Resampled values held in memory at once by the bootstrap.
+BOOTSTRAP_CHUNK = 1 << 22
+
+
+def _read_lines(filename):
+    """Yield the samples of a JSON lines file."""
+    with open(filename, 'r') as f:
+        for line in f:
+            sample = json.loads(line)
+            if 'seconds' in sample:
+                yield sample
+
+
+def load(filenames, phase=None, **filters):
+    """Return (playbook, running) -> list of seconds, NaN for failed samples.
+
+    Args:
+        filenames (list): SQLite stores, JSON lines files of measure.py or
+            legacy pickles, whose name tells whether the PLC was running.
+        phase (str, optional): use the time of this phase (e.g. 'login')
+            instead of the whole sample. Defaults to None.
+        **filters: slice of a store, see ResultStore.query(). Without a
+            run_id or git_commit filter only the latest run matching the
+            other filters is used.
+    """
+    groups = defaultdict(list)
+    for filename in filenames:
+        if filename.endswith('.p'):
+            running = 'notrunning' not in filename
+            with open(filename, 'rb') as handle:
+                for playbook, values in pickle.load(handle).items():
+                    groups[playbook, running] += [v if v >= 0 else np.nan
+                                                  for v in values]
+            continue
+        if filename.endswith('.jsonl'):
+            samples = _read_lines(filename)
+        else:
+            store = ResultStore(filename)
+            sliced = dict(filters)
+            if sliced.get('run_id') is None and sliced.get('git_commit') is None:
+                # Never mix every commit and run of a store by accident.
+                runs = store.runs(**sliced)
+                sliced['run_id'] = runs[-1]['run_id'] if runs else None
+                print(f"{filename}: latest run {sliced['run_id']}")
+            samples = store.query(**sliced)
+            store.close()
+        for sample in samples:
+            value = sample['seconds'] if phase is None else \
+                sample['phases'].get(phase, 0.0)
+            groups[sample['playbook'], sample['running']].append(
+                value if sample['ok'] else np.nan)
+    return groups
+
+
+def _bootstrap_medians(values, bootstrap, rng, chunk=BOOTSTRAP_CHUNK):
+    """Return bootstrap medians of values, resampled in bounded chunks."""
+    medians = np.empty(bootstrap)
+    rows = max(1, chunk // len(values))
+    for start in range(0, bootstrap, rows):
+        picks = rng.integers(0, len(values),
+                             (min(rows, bootstrap - start), len(values)))
+        medians[start:start + len(picks)] = np.median(values[picks], axis=1)
+    return medians
+
+
+def summarise(groups, bootstrap=BOOTSTRAP, confidence=CONFIDENCE, seed=0):
+    """Return statistics of every group.
+
+    Returns:
+        dict: (playbook, running) -> n, failures, mean, std, p50, p90, p99,
+            ci_low and ci_high of the median.
+    """
+    keys = sorted(groups, key=lambda k: (k[1], k[0]))
+    if not keys:
+        return {}
+    width = max(len(groups[k]) for k in keys)
+    # One row per group, failures and padding are NaN.
+    samples = np.full((len(keys), width), np.nan)
+    for row, key in enumerate(keys):
+        samples[row, :len(groups[key])] = groups[key]
+    counts = (~np.isnan(samples)).sum(axis=1)
+
+    # Groups with only failures give all-NaN rows, which NumPy warns about.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        percentiles = np.nanpercentile(samples, PERCENTILES, axis=1)
+        mean, std = np.nanmean(samples, axis=1), np.nanstd(samples, axis=1)
+    # Bootstrap the median of every group, resampling with replacement.
+    rng = np.random.default_rng(seed)
+    alpha = (1 - confidence) / 2 * 100
+    ci_low, ci_high = np.full(len(keys), np.nan), np.full(len(keys), np.nan)
+    for i in range(len(keys)):
+        values = samples[i][~np.isnan(samples[i])]
+        if len(values):
+            ci_low[i], ci_high[i] = np.percentile(
+                _bootstrap_medians(values, bootstrap, rng), [alpha, 100 - alpha])
+
+    return {key: dict(n=int(counts[i]), failures=len(groups[key]) - int(counts[i]),
+                      mean=mean[i], std=std[i], p50=percentiles[0][i],
+                      p90=percentiles[1][i], p99=percentiles[2][i],
+                      ci_low=ci_low[i], ci_high=ci_high[i])
+            for i, key in enumerate(keys)}
+
+
+def _state(running):
+    return 'running' if running else 'notrunning'
+
+
+def print_summary(summary, decimals=3):
+    """Print one line per group."""
+    print(f"{'playbook':<22}{'state':<12}{'n':>5}{'fail':>6}{'median':>10}"
+          f"{'p90':>10}{'p99':>10}{'95% CI median':>22}")
+    for (playbook, running), s in summary.items():
+        ci = f"[{s['ci_low']:.{decimals}f}, {s['ci_high']:.{decimals}f}]"
+        print(f"{playbook:<22}{_state(running):<12}{s['n']:>5}{s['failures']:>6}"
+              f"{s['p50']:>10.{decimals}f}{s['p90']:>10.{decimals}f}"
+              f"{s['p99']:>10.{decimals}f}{ci:>22}")
+
+
+def save_baseline(summary, filename):
+    """Store the summary as baseline, keyed by playbook and state."""
+    baseline = {f'{playbook}|{_state(running)}': {k: float(v) for k, v in s.items()}
+                for (playbook, running), s in summary.items()}
+    with open(filename, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+
+def compare(summary, filename, threshold):
+    """Return the groups whose median regressed beyond threshold.
+
+    A group regressed when its median is more than threshold (a fraction)
+    above the baseline median and the lower end of its confidence interval
+    is above the baseline median too, so noise alone does not fail a run.
+    Groups whose failure rate increased count as regressions as well.
+    """
+    with open(filename, 'r') as f:
+        baseline = json.load(f)
+    regressions = []
+    for (playbook, running), s in summary.items():
+        old = baseline.get(f'{playbook}|{_state(running)}')
+        if old is None:
+            continue
+        slower = s['p50'] > old['p50'] * (1 + threshold) and s['ci_low'] > old['p50']
+        # Rates, runs may have a different number of rounds than the baseline.
+        rate = s['failures'] / max(1, s['n'] + s['failures'])
+        old_rate = old['failures'] / max(1, old['n'] + old['failures'])
+        if slower or rate > old_rate:
+            regressions.append(dict(playbook=playbook, state=_state(running),
+                                    baseline=old['p50'], median=float(s['p50']),
+                                    failures=s['failures'], failure_rate=rate,
+                                    baseline_failure_rate=old_rate))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('files', nargs='+',
+                        help='SQLite store, JSON lines or pickle results')
+    parser.add_argument('--phase', help='analyse one phase, e.g. login or post')
+    parser.add_argument('--run', nargs='+',
+                        help='only these run ids, default the latest run of a store')
+    parser.add_argument('--host', nargs='+', help='only these hosts')
+    parser.add_argument('--plugin', nargs='+', help='only these plugins')
+    parser.add_argument('--playbook', nargs='+', help='only these playbooks')
+    parser.add_argument('--commit', nargs='+', help='only these git commits')
+    parser.add_argument('--bootstrap', type=int, default=BOOTSTRAP)
+    parser.add_argument('--baseline', help='baseline to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='allowed slowdown of the median, 0.1 is 10%%')
+    parser.add_argument('--save-baseline', help='store these results as baseline')
+    args = parser.parse_args()
+
+    groups = load(args.files, args.phase, run_id=args.run, host=args.host,
+                  plugin=args.plugin, playbook=args.playbook, git_commit=args.commit)
+    summary = summarise(groups, bootstrap=args.bootstrap)
+    print_summary(summary)
+    if args.save_baseline:
+        save_baseline(summary, args.save_baseline)
+    if args.baseline:
+        regressions = compare(summary, args.baseline, args.threshold)
+        for r in regressions:
+            print(f"REGRESSION {r['playbook']} ({r['state']}): median "
+                  f"{r['baseline']:.3f}s -> {r['median']:.3f}s, "
+                  f"failure rate {r['baseline_failure_rate']:.1%} -> "
+                  f"{r['failure_rate']:.1%}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
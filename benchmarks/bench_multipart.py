@@ -0,0 +1,63 @@
+"""File: bench_multipart.py
+
+Peak memory of building a program/picture upload body, streamed from disk by
+the openplc connection versus read into memory as the plugins used to.
+Every measurement runs in a fresh process, so the peak RSS is its own.
+
+    python benchmarks/bench_multipart.py --sizes 1 8 32 128
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+from bench_parsers import load_connection
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def encode(mode, filename):
+    """Build the multipart body of filename and drop it chunk by chunk."""
+    files = {'file': [os.path.basename(filename), filename, 'text']}
+    if mode == 'stream':
+        for _ in load_connection().MultipartStream({}, files):
+            pass
+    else:
+        from requests.models import RequestEncodingMixin
+        with open(filename, 'rb') as f:
+            files = {'file': (os.path.basename(filename), f.read(), 'text')}
+        body, _ = RequestEncodingMixin._encode_files(files, {})
+        del body
+
+
+def measure(mode, size_mb):
+    """Return the peak RSS in MB of encoding a size_mb file in a new process."""
+    with tempfile.NamedTemporaryFile(suffix='.st') as f:
+        f.write(b'(* generated *)\n' * (size_mb * 1024 * 1024 // 16))
+        f.flush()
+        ret = subprocess.run([sys.executable, __file__, '--child', mode, f.name],
+                             capture_output=True, text=True, check=True)
+    return float(ret.stdout)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 8, 32, 128],
+                        help='file sizes in MB')
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'FILE'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        encode(*args.child)
+        print(peak_rss_mb())
+    else:
+        print(f"{'file MB':>8} {'stream RSS MB':>14} {'in-memory RSS MB':>17}")
+        for size in args.sizes:
+            print(f"{size:>8} {measure('stream', size):>14.1f} "
+                  f"{measure('inmemory', size):>17.1f}")
@@ -0,0 +1,131 @@
+"""File: bench_parsers.py
+
+Micro-benchmark of the HTML parsing done for every openplc_* task, on
+synthetic pages shaped like the OpenPLCv3 webserver output.
+
+    python benchmarks/bench_parsers.py --rows 10000
+"""
+import argparse
+import importlib.util
+import os
+import re
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_connection():
+    """Import the openplc connection plugin, which holds the parsers."""
+    path = os.path.join(ROOT, 'connection_plugins', 'openplc.py')
+    spec = importlib.util.spec_from_file_location('openplc_connection', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def programs_page(rows, malformed=0):
+    """Return a programs?list_all=1 page with rows programs."""
+    header = ("<table><tr style='background-color: white'><th>Program Name</th>"
+              "<th>File</th><th>Date Uploaded</th></tr>")
+    body = ''.join(
+        f"<tr onclick=\"document.location='reload-program?table_id={i}'\">"
+        f"<td>program {i}</td><td>{100000 + i}.st</td><td>Oct 18, 2026</td></tr>\n"
+        for i in range(rows))
+    broken = ''.join(f"<tr><td>broken {i}</td></tr>\n" for i in range(malformed))
+    return header + body + broken + '</table>'
+
+
+def device_page(inputs=20, code_lines=0):
+    """Return a modbus-edit-device like page, optionally with a code textarea."""
+    fields = ''.join(f"<label>Field {i}</label><input type='text' id='field{i}' "
+                     f"name='field_{i}' value='{i}'>\n" for i in range(inputs))
+    select = ("<select id='dev_protocol' name='device_protocol'>"
+              "<option value='Uno'>Arduino Uno</option>"
+              "<option selected='selected' value='TCP'>Generic TCP</option>"
+              "<option value='RTU'>Generic RTU</option></select>")
+    code = '\n'.join(f'    psm.set_var("IX0.{i % 8}", True)' for i in range(code_lines))
+    textarea = f'<textarea name="custom_layer_code" rows="20">{code}</textarea>'
+    script = ('<script>;devid.value = "1";devip.value = "192.168.0.1";'
+              'distart.value = "0";disize.value = "8";}</script>')
+    return f'<html><form>{fields}{select}{textarea}</form>{script}</html>'
+
+
+def legacy_details(text):
+    """The four scans of _details() plus the textarea scan of hardware._add()."""
+    properties = dict()
+    bottom = re.search(";devid.value.*?;}", text, re.DOTALL)
+    if bottom is not None:
+        for p in bottom.group().split(';'):
+            if '=' in p:
+                attr, val = p.split(' = ')
+                properties[attr[:-6].replace('dev', 'device_').replace(
+                    'start', '_start').replace('size', '_size')] = val[1:-1]
+    for r in re.findall('<input .*?>', text, re.DOTALL):
+        name = re.findall("name='.*?'", r)
+        value = re.findall("value='.*?'", r)
+        if value and name:
+            properties[name[0][6:-1]] = value[0][7:-1]
+    properties['device_protocol'] = re.findall(
+        "value='.*?'", re.findall("selected='selected'.*?>", text, re.DOTALL)[0])[0][7:-1]
+    return {**properties,
+            **{re.findall('name=".*?"', r)[0][6:-1]:
+               r.split('>', 1)[1].replace('</textarea>', '')
+               for r in re.findall('<textarea .*?>.*?</textarea>', text, re.DOTALL)
+               if '>' in r}}
+
+
+def details(parse_form, text):
+    """The properties _details() builds from parse_form()."""
+    form = parse_form(text)
+    return {**form['script'], **form['inputs'], **form['textareas'],
+            'device_protocol': form['selected']['device_protocol']}
+
+
+def legacy_get_known(text, column=1):
+    """The nested regex scans the plugins used before parse_table()."""
+    return {re.findall("<td>.*?</td>", row)[column][4:-5]:
+            re.search("table_id=.*?'", row).group()[9:-1] for row in
+            re.findall("<tr.*?>.*?</tr>", text, re.DOTALL)[1:]}
+
+
+def get_known(parse_table, text, column=1):
+    """The index _get_known() builds from parse_table()."""
+    rows, _ = parse_table(text)
+    return {row['cells'][column]: row['id'] for row in rows
+            if len(row['cells']) > column}
+
+
+def bench(name, function, number, repeat):
+    """Print the best time per call of function in milliseconds."""
+    best = min(timeit.repeat(function, number=number, repeat=repeat)) / number
+    print(f'{name:<24} {best * 1000:9.2f} ms')
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--number', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    connection = load_connection()
+    page = programs_page(args.rows)
+    assert legacy_get_known(page) == get_known(connection.parse_table, page)
+    print(f'programs page, {args.rows} rows, {len(page)} bytes')
+    legacy = bench('legacy _get_known', lambda: legacy_get_known(page),
+                   args.number, args.repeat)
+    new = bench('parse_table', lambda: get_known(connection.parse_table, page),
+                args.number, args.repeat)
+    print(f'speedup {legacy / new:.1f}x')
+    _, malformed = connection.parse_table(programs_page(args.rows, malformed=3))
+    print('malformed rows reported:', [m['row'] for m in malformed])
+
+    page = device_page(inputs=args.rows // 100, code_lines=args.rows)
+    assert legacy_details(page) == details(connection.parse_form, page)
+    print(f'\nedit page, {args.rows // 100} inputs, {len(page)} bytes')
+    legacy = bench('legacy _details', lambda: legacy_details(page),
+                   args.number, args.repeat)
+    new = bench('parse_form', lambda: details(connection.parse_form, page),
+                args.number, args.repeat)
+    print(f'speedup {legacy / new:.1f}x')
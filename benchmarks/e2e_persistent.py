@@ -0,0 +1,123 @@
+"""File: e2e_persistent.py
+
+End-to-end check of the persistent connection against mock_openplc.py.
+
+Starts the mock on a free port, points an inventory host with
+ansible_connection=openplc at it and runs a playbook with ansible-playbook,
+so every openplc_* task talks JSON-RPC to ansible-connection. Exits 1 when
+the play fails, when the PLC does not end in the expected state or when the
+play logged in more than once.
+
+    python benchmarks/e2e_persistent.py
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import uuid
+from http.server import ThreadingHTTPServer
+
+import yaml
+
+from mock_openplc import Handler, MockPLC
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USER = dict(full_name='Persistent User', user_email='persistent@example.com',
+            user_password='thisisnotapassword')
+DEVICE = dict(device_protocol='TCP', device_id='688', device_ip='192.168.5.6',
+              device_port='502', device_baud='115200', device_parity='None',
+              device_data='8', device_stop='1', device_pause='0',
+              di_start='1', di_size='8', do_start='1', do_size='8',
+              ai_start='1', ai_size='8', aor_start='1', aor_size='8',
+              aow_start='1', aow_size='8')
+TASKS = [
+    {'name': 'Snapshot the PLC', 'openplc_facts': dict(workers=4, details=True)},
+    {'name': 'Add a user', 'openplc_user': dict(
+        user_name='persistent', properties=USER, state='present')},
+    {'name': 'Add the user again', 'register': 'again', 'openplc_user': dict(
+        user_name='persistent', properties=USER, state='present')},
+    {'name': 'Adding it again changed nothing',
+     'assert': dict(that=['not again.changed'])},
+    {'name': 'Add a device', 'openplc_device': dict(
+        device_name='Persistent device', properties=DEVICE, state='present')},
+    {'name': 'Change a setting', 'openplc_settings': dict(
+        properties=dict(slave_polling_period=101), state='present')},
+    {'name': 'Remove the user', 'openplc_user': dict(
+        user_name='persistent', properties=dict(unchecked='removing'),
+        state='absent')},
+]
+
+
+def serve(plc):
+    """Serve plc on a free local port in a thread, return the server."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.plc = plc
+    server.latency, server.jitter, server.verbose = 0, 0, False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_play(port, verbose=False):
+    """Run TASKS with ansible-playbook over the persistent connection."""
+    work = tempfile.mkdtemp(prefix='openplc-e2e-')
+    inventory = os.path.join(work, 'hosts')
+    with open(inventory, 'w') as f:
+        f.write(f'openplc ansible_host=127.0.0.1 http_port={port} username=openplc '
+                'password=openplc ansible_connection=openplc '
+                'openplc_session_cache_ttl=0\n')
+    # Next to action_plugins and connection_plugins, so ansible finds them.
+    playbook = os.path.join(ROOT, f'.e2e_{uuid.uuid4().hex}.yml')
+    with open(playbook, 'w') as f:
+        yaml.safe_dump([dict(hosts='openplc', gather_facts=False, tasks=TASKS)], f)
+    env = dict(os.environ, ANSIBLE_PERSISTENT_CONTROL_PATH_DIR=work)
+    try:
+        ret = subprocess.run(['ansible-playbook', playbook, '-i', inventory],
+                             capture_output=not verbose, text=True, cwd=ROOT,
+                             env=env)
+    finally:
+        os.remove(playbook)
+        shutil.rmtree(work, ignore_errors=True)
+    return ret
+
+
+def check(plc):
+    """Return the differences between plc and the state the play leaves."""
+    errors = []
+    if len(plc.sessions) != 1:
+        errors.append(f'{len(plc.sessions)} logins, expected 1')
+    if any(u['user_name'] == 'persistent' for u in plc.users.values()):
+        errors.append('user persistent was not removed')
+    if plc.settings['slave_polling_period'] != '101':
+        errors.append(f"slave_polling_period is "
+                      f"{plc.settings['slave_polling_period']}, expected 101")
+    devices = [d for d in plc.devices.values()
+               if d['device_name'] == 'Persistent device']
+    if len(devices) != 1 or devices[0]['device_id'] != '688':
+        errors.append(f'device not added as expected: {devices}')
+    return errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show the ansible-playbook output')
+    args = parser.parse_args()
+
+    plc = MockPLC()
+    server = serve(plc)
+    try:
+        ret = run_play(server.server_address[1], args.verbose)
+    finally:
+        server.shutdown()
+    if ret.returncode != 0:
+        print(ret.stdout or '', ret.stderr or '', sep='\n', file=sys.stderr)
+        sys.exit(f'ansible-playbook failed with exit code {ret.returncode}')
+    errors = check(plc)
+    for error in errors:
+        print('FAIL', error, file=sys.stderr)
+    if errors:
+        sys.exit(1)
+    print('persistent connection ok')
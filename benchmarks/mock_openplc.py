@@ -0,0 +1,466 @@
+"""File: mock_openplc.py
+
+Local stand-in for the OpenPLCv3 webserver, to run the plugins, measure.py
+and scale tests without a PLC.
+
+Serves the pages the openplc_* plugins use, in the HTML shapes their
+parsers expect: login, users, edit-user, add-user, delete-user, modbus,
+modbus-edit-device, add-modbus-device, delete-device, settings, hardware,
+programs, upload-program(-action), reload-program, update-program-action,
+compile-program, compilation-logs, remove-program, start_plc, stop_plc,
+runtime_logs and dashboard. State lives in memory only.
+
+    python benchmarks/mock_openplc.py --port 8080 --users 1000 --devices 1000 \
+        --programs 5000 --latency 0.02 --compile-time 3
+
+and point an inventory host at it, e.g.
+`openplc ansible_host=127.0.0.1 http_port=8080 username=openplc password=openplc`.
+openplc_file_upload also uses ssh for the program files, which the mock
+does not provide.
+"""
+import argparse
+import html
+import random
+import re
+import secrets
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+COOKIE = 'session'
+# Programs without END_PROGRAM fail to compile, to test error handling.
+COMPILES = re.compile('END_PROGRAM')
+DEVICE_SCRIPT = ['device_id', 'device_ip', 'device_port', 'device_baud',
+                 'device_parity', 'device_data', 'device_stop', 'device_pause',
+                 'di_start', 'di_size', 'do_start', 'do_size', 'ai_start',
+                 'ai_size', 'aor_start', 'aor_size', 'aow_start', 'aow_size']
+PROTOCOLS = {'Uno': 'Arduino Uno', 'Mega': 'Arduino Mega', 'ESP32': 'ESP32',
+             'ESP8266': 'ESP8266', 'TCP': 'Generic Modbus TCP Device',
+             'RTU': 'Generic Modbus RTU Device'}
+HARDWARE_LAYERS = {'blank': 'Blank', 'blank_linux': 'Blank with DNP3 (Linux only)',
+                   'psm_linux': 'Python on Linux (PSM)', 'rpi': 'Raspberry Pi',
+                   'simulink': 'Simulink'}
+# Settings page: checkbox id -> field that holds its value.
+SETTINGS = {'modbus_server': 'modbus_server_port', 'dnp3_server': 'dnp3_server_port',
+            'enip_server': 'enip_server_port', 'pstorage_thread': 'pstorage_thread_poll',
+            'auto_run': 'auto_run_text'}
+
+
+def _script_name(prop):
+    """Return the variable of the device page script for a device property."""
+    return prop.replace('device_', 'dev').replace('_start', 'start').replace('_size', 'size')
+
+
+def _options(options, selected):
+    """Return <option> tags with selected marked the OpenPLC way."""
+    return ''.join(f"<option selected='selected' value='{v}'>{label}</option>"
+                   if v == selected else f"<option value='{v}'>{label}</option>"
+                   for v, label in options.items())
+
+
+def _page(title, body):
+    """Wrap body in the page layout."""
+    return (f"<html><head><title>OpenPLC - {title}</title></head><body>"
+            f"<div class='top'><h2>{title}</h2></div>{body}</body></html>")
+
+
+def _table(headers, rows, link):
+    """Return a listing table, every row linking to link=<id>."""
+    head = ''.join(f'<th>{h}</th>' for h in headers)
+    body = ''.join(
+        f"<tr onclick=\"document.location='{link}={i}'\">"
+        + ''.join(f'<td>{html.escape(str(c))}</td>' for c in cells) + '</tr>\n'
+        for i, cells in rows)
+    return f"<table><tr style='background-color: white'>{head}</tr>\n{body}</table>"
+
+
+class MockPLC:
+    """In-memory state of one OpenPLC runtime."""
+
+    def __init__(self, users=1, devices=0, programs=1, compile_time=1.0,
+                 username='openplc', password='openplc'):
+        self.lock = threading.Lock()
+        self.compile_time = compile_time
+        self.sessions = set()
+        self.ids = iter(range(1, 1 << 31))
+        self.users = {next(self.ids): dict(full_name='OpenPLC User', user_name=username,
+                                           user_email='openplc@openplc.com',
+                                           user_password=password)}
+        for i in range(users - 1):
+            self.users[next(self.ids)] = dict(
+                full_name=f'User {i}', user_name=f'user{i}',
+                user_email=f'user{i}@example.com', user_password=f'secret{i}')
+        self.devices = {}
+        for i in range(devices):
+            self.devices[next(self.ids)] = dict(
+                {p: '0' for p in DEVICE_SCRIPT}, device_name=f'Device {i}',
+                device_protocol='TCP', device_id=str(i), device_ip='192.168.0.1',
+                device_port='502')
+        self.programs = {}
+        for i in range(programs):
+            self.programs[next(self.ids)] = dict(
+                prog_name=f'Program {i}', prog_descr='', prog_file=f'{100000 + i}.st',
+                date_upload=int(time.time()))
+        self.files = {p['prog_file']: b'PROGRAM prog0\nEND_PROGRAM\n'
+                      for p in self.programs.values()}
+        self.settings = dict(modbus_server_port='502', dnp3_server_port='20000',
+                             enip_server_port='44818', pstorage_thread_poll='disabled',
+                             auto_run_text='false', slave_polling_period='100',
+                             slave_timeout='1000')
+        self.hardware = dict(hardware_layer='blank', custom_layer_code='')
+        self.running = False
+        self.compilation = None
+
+    def login(self, form):
+        """Return a new session token for valid credentials."""
+        with self.lock:
+            for user in self.users.values():
+                if (user['user_name'], user['user_password']) == \
+                        (form.get('username'), form.get('password')):
+                    token = secrets.token_hex(16)
+                    self.sessions.add(token)
+                    return token
+        return None
+
+    def compile(self, filename):
+        """Start a (simulated) compilation of an uploaded program."""
+        source = self.files.get(filename, b'').decode(errors='replace')
+        self.running = False
+        self.compilation = dict(file=filename, start=time.monotonic(),
+                                ok=COMPILES.search(source) is not None)
+
+    def compiling(self, filename):
+        """Return whether filename is being compiled right now."""
+        c = self.compilation
+        return c is not None and c['file'] == filename and \
+            time.monotonic() - c['start'] < self.compile_time
+
+    def compilation_logs(self):
+        """Return the log of the last compilation so far."""
+        if self.compilation is None:
+            return ''
+        c = self.compilation
+        log = f"Compiling {c['file']}...\nOptimizing ST program...\n"
+        if time.monotonic() - c['start'] < self.compile_time:
+            return log
+        if c['ok']:
+            return log + 'Generating C files...\nCompilation finished successfully!'
+        return (log + f"{c['file']}: syntax error\n1 error(s) found. Bailing out!\n"
+                "Compilation finished with errors!")
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serves one request against the MockPLC of the server."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    @property
+    def plc(self):
+        return self.server.plc
+
+    def _delay(self):
+        """Wait the configured latency (with jitter)."""
+        latency = self.server.latency + random.uniform(0, self.server.jitter)
+        if latency:
+            time.sleep(latency)
+
+    def _send(self, status=200, body='', headers=()):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _redirect(self, location, headers=()):
+        self._send(302, '', [('Location', '/' + location), *headers])
+
+    def _logged_in(self):
+        for cookie in self.headers.get_all('Cookie', []):
+            for pair in cookie.split(';'):
+                name, _, value = pair.strip().partition('=')
+                if name == COOKIE and value in self.plc.sessions:
+                    return True
+        return False
+
+    def _form(self):
+        """Return the url-encoded or multipart form and the uploaded files."""
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        content_type = self.headers.get('Content-Type', '')
+        if not content_type.startswith('multipart/form-data'):
+            return dict(parse_qsl(body.decode(), keep_blank_values=True)), {}
+        message = BytesParser(policy=HTTP).parsebytes(
+            f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+        form, files = {}, {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if part.get_filename() is not None:
+                files[name] = (part.get_filename(), part.get_payload(decode=True))
+            else:
+                form[name] = part.get_payload(decode=True).decode()
+        return form, files
+
+    def do_GET(self):
+        self._delay()
+        url = urlsplit(self.path)
+        page, query = url.path.strip('/'), dict(parse_qsl(url.query))
+        if page == 'login':
+            return self._send(body=_page('Login', "<form method='post'>"
+                              "<input type='text' id='username' name='username'>"
+                              "<input type='password' id='password' name='password'>"
+                              "</form>"))
+        if not self._logged_in():
+            return self._redirect('login')
+        handler = getattr(self, 'get_' + page.replace('-', '_'), None)
+        if handler is None:
+            return self._send(404, _page('Error', f'No page {page}'))
+        with self.plc.lock:
+            try:
+                return handler(query)
+            except (KeyError, ValueError) as e:
+                return self._send(500, _page('Error', f'Bad request: {e!r}'))
+
+    def do_POST(self):
+        self._delay()
+        page = urlsplit(self.path).path.strip('/')
+        form, files = self._form()
+        if page == 'login':
+            token = self.plc.login(form)
+            if token is None:
+                return self._send(401, _page('Login', 'Bad credentials'))
+            return self._redirect('dashboard',
+                                  [('Set-Cookie', f'{COOKIE}={token}; Path=/')])
+        if not self._logged_in():
+            return self._redirect('login')
+        handler = getattr(self, 'post_' + page.replace('-', '_'), None)
+        if handler is None:
+            return self._send(404, _page('Error', f'No page {page}'))
+        with self.plc.lock:
+            try:
+                return handler(form, files)
+            except (KeyError, ValueError) as e:
+                return self._send(500, _page('Error', f'Bad request: {e!r}'))
+
+    # Runtime.
+    def get_dashboard(self, query):
+        state = 'Running' if self.plc.running else 'Stopped'
+        self._send(body=_page('Dashboard', f'<p>Status: {state}</p>'))
+
+    def get_runtime_logs(self, query):
+        self._send(body='OpenPLC Runtime starting...\n')
+
+    def get_start_plc(self, query):
+        self.plc.running = True
+        self._redirect('dashboard')
+
+    def get_stop_plc(self, query):
+        self.plc.running = False
+        self._redirect('dashboard')
+
+    # Users.
+    def get_users(self, query):
+        rows = [(i, [u['full_name'], u['user_name'], u['user_email']])
+                for i, u in self.plc.users.items()]
+        self._send(body=_page('Users', _table(
+            ['Full Name', 'Username', 'Email'], rows, 'edit-user?table_id')))
+
+    def get_edit_user(self, query):
+        i = int(query['table_id'])
+        user = self.plc.users[i]
+        fields = ''.join(
+            f"<label>{p}</label><input type='text' id='{p}' name='{p}' "
+            f"value='{html.escape(user[p], quote=True)}'>\n"
+            for p in ['full_name', 'user_name', 'user_email'])
+        self._send(body=_page('Edit User', (
+            f"<form method='post'><input type='hidden' value='{i}' id='user_id' "
+            f"name='user_id'/>{fields}<input type='password' id='user_password' "
+            f"name='user_password' value='{html.escape(user['user_password'], quote=True)}'>"
+            "<input type='file' id='file' name='file' accept='image/*'></form>")))
+
+    def post_add_user(self, form, files):
+        self.plc.users[next(self.plc.ids)] = {
+            p: form.get(p, '') for p in
+            ['full_name', 'user_name', 'user_email', 'user_password']}
+        self._redirect('users')
+
+    def post_edit_user(self, form, files):
+        user = self.plc.users[int(form['user_id'])]
+        user.update({p: form[p] for p in user if p in form})
+        self._redirect('users')
+
+    def get_delete_user(self, query):
+        del self.plc.users[int(query['user_id'])]
+        self._redirect('users')
+
+    # Slave devices.
+    def get_modbus(self, query):
+        rows = [(i, [d['device_name'], d['device_protocol'],
+                     d['di_start'], d['do_start'], d['ai_start'], d['aor_start']])
+                for i, d in self.plc.devices.items()]
+        self._send(body=_page('Slave Devices', _table(
+            ['Device Name', 'Device Type', 'DI', 'DO', 'AI', 'AO'], rows,
+            'modbus-edit-device?table_id')))
+
+    def get_modbus_edit_device(self, query):
+        i = int(query['table_id'])
+        device = self.plc.devices[i]
+        script = ''.join(f';{_script_name(p)}.value = "{device[p]}"'
+                         for p in DEVICE_SCRIPT)
+        self._send(body=_page('Edit Device', (
+            f"<form method='post'><input type='hidden' value='{i}' id='db_dev_id' "
+            f"name='db_dev_id'/><input type='text' id='dev_name' name='device_name' "
+            f"value='{html.escape(device['device_name'], quote=True)}'>"
+            f"<select id='dev_protocol' name='device_protocol'>"
+            f"{_options(PROTOCOLS, device['device_protocol'])}</select></form>"
+            f"<script>var devid = document.getElementById('dev_id')"
+            f"{script};}}</script>")))
+
+    def post_add_modbus_device(self, form, files):
+        # The form fields override the defaults, device_protocol included.
+        self.plc.devices[next(self.plc.ids)] = {
+            **{p: '0' for p in DEVICE_SCRIPT}, 'device_protocol': 'TCP', **form}
+        self._redirect('modbus')
+
+    def post_modbus_edit_device(self, form, files):
+        device = self.plc.devices[int(form['db_dev_id'])]
+        device.update({p: form[p] for p in device if p in form})
+        self._redirect('modbus')
+
+    def get_delete_device(self, query):
+        del self.plc.devices[int(query['dev_id'])]
+        self._redirect('modbus')
+
+    # Settings and hardware.
+    def get_settings(self, query):
+        settings, fields = self.plc.settings, ''
+        for checkbox, field in SETTINGS.items():
+            enabled = settings[field] not in ('disabled', 'false')
+            value = settings[field] if field != 'auto_run_text' else \
+                str(enabled).lower()
+            fields += (f"<input id='{checkbox}' type='checkbox'"
+                       f"{' checked' if enabled else ''}>"
+                       f"<input type='text' id='{field}' name='{field}' value='{value}'>\n")
+        for field in ['slave_polling_period', 'slave_timeout']:
+            fields += (f"<input type='text' id='{field}' name='{field}' "
+                       f"value='{settings[field]}'>\n")
+        self._send(body=_page('Settings', f"<form method='post'>{fields}</form>"))
+
+    def post_settings(self, form, files):
+        # Like OpenPLC, a missing field disables its setting.
+        for field in SETTINGS.values():
+            self.plc.settings[field] = form.get(field, 'disabled')
+        if self.plc.settings['auto_run_text'] != 'true':
+            self.plc.settings['auto_run_text'] = 'false'
+        for field in ['slave_polling_period', 'slave_timeout']:
+            self.plc.settings[field] = form[field]
+        self._redirect('dashboard')
+
+    def get_hardware(self, query):
+        hardware = self.plc.hardware
+        self._send(body=_page('Hardware', (
+            "<form method='post'><select id='hardware_layer' name='hardware_layer'>"
+            f"{_options(HARDWARE_LAYERS, hardware['hardware_layer'])}</select>"
+            f'<textarea name="custom_layer_code" id="custom_layer_code" rows="20">'
+            f"{hardware['custom_layer_code']}</textarea></form>")))
+
+    def post_hardware(self, form, files):
+        self.plc.hardware.update({p: form[p] for p in self.plc.hardware if p in form})
+        self._redirect('dashboard')
+
+    # Programs.
+    def get_programs(self, query):
+        programs = sorted(self.plc.programs.items(), reverse=True)
+        if 'list_all' not in query:
+            programs = programs[:20]
+        rows = [(i, [p['prog_name'], p['prog_file'],
+                     time.strftime('%b %d, %Y', time.localtime(p['date_upload']))])
+                for i, p in programs]
+        self._send(body=_page('Programs', _table(
+            ['Program Name', 'File', 'Date Uploaded'], rows, 'reload-program?table_id')))
+
+    def _program_form(self, action, filename, name='', description=''):
+        return _page('Program Info', (
+            f"<form method='post' action='{action}'>"
+            f"<input type='text' id='prog_name' name='prog_name' value='{name}'>"
+            f"<textarea id='prog_descr' name='prog_descr'>{description}</textarea>"
+            f"<input type='hidden' value='{filename}' id='prog_file' name='prog_file'/>"
+            "</form>"))
+
+    def post_upload_program(self, form, files):
+        _, content = files['file']
+        filename = f'{random.randint(100000, 999999)}.st'
+        self.plc.files[filename] = content
+        self._send(body=self._program_form('upload-program-action', filename))
+
+    def post_upload_program_action(self, form, files):
+        self.plc.programs[next(self.plc.ids)] = dict(
+            prog_name=form['prog_name'], prog_descr=form.get('prog_descr', ''),
+            prog_file=form['prog_file'], date_upload=int(float(form['epoch_time'])))
+        self.plc.compile(form['prog_file'])
+        self._redirect(f"compile-program?file={form['prog_file']}")
+
+    def get_reload_program(self, query):
+        program = self.plc.programs[int(query['table_id'])]
+        self._send(body=self._program_form('update-program-action', program['prog_file'],
+                                           program['prog_name'], program['prog_descr']))
+
+    def post_update_program_action(self, form, files):
+        for program in self.plc.programs.values():
+            if program['prog_file'] == form['prog_file']:
+                program.update(prog_name=form['prog_name'],
+                               prog_descr=form.get('prog_descr', ''),
+                               date_upload=int(float(form['epoch_time'])))
+        self._redirect('dashboard')
+
+    def get_compile_program(self, query):
+        if not self.plc.compiling(query['file']):
+            self.plc.compile(query['file'])
+        self._send(body=_page('Compiling', f"<pre>Compiling {query['file']}</pre>"))
+
+    def get_compilation_logs(self, query):
+        self._send(body=self.plc.compilation_logs())
+
+    def get_remove_program(self, query):
+        del self.plc.programs[int(query['id'])]
+        self._redirect('programs')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--bind', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--username', default='openplc')
+    parser.add_argument('--password', default='openplc')
+    parser.add_argument('--users', type=int, default=1, help='rows in users')
+    parser.add_argument('--devices', type=int, default=0, help='rows in modbus')
+    parser.add_argument('--programs', type=int, default=1, help='rows in programs')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='random extra latency up to this many seconds')
+    parser.add_argument('--compile-time', type=float, default=1,
+                        help='seconds a compilation takes')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.bind, args.port), Handler)
+    server.plc = MockPLC(args.users, args.devices, args.programs,
+                         args.compile_time, args.username, args.password)
+    server.latency, server.jitter = args.latency, args.jitter
+    server.verbose = args.verbose
+    print(f'Mock OpenPLC on http://{args.bind}:{args.port}/ '
+          f'({args.username}/{args.password})')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
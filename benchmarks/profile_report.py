@@ -0,0 +1,97 @@
+"""File: profile_report.py
+
+Merge the .pstats files written with OPENPLC_PROFILE=dir into one report.
+
+Prints the functions with the most cumulative time and writes the merged
+profile as collapsed stacks ("a;b;c microseconds" per line), which
+flamegraph.pl, speedscope and inferno read.
+
+    OPENPLC_PROFILE=profiles ansible-playbook example.yml -i hosts
+    python benchmarks/profile_report.py profiles --collapsed openplc.folded
+"""
+import argparse
+import glob
+import os
+import pstats
+from collections import defaultdict
+
+
+def load(paths, connection=None):
+    """Merge .pstats files, with connection only/without -connection files."""
+    files = []
+    for path in paths:
+        files += sorted(glob.glob(os.path.join(path, '*.pstats'))) \
+            if os.path.isdir(path) else [path]
+    if connection is not None:
+        files = [f for f in files if f.endswith('-connection.pstats') == connection]
+    if not files:
+        raise SystemExit(f'No .pstats files in {paths}')
+    return pstats.Stats(*files), len(files)
+
+
+def label(function):
+    """Return file:line(name) of a pstats function key."""
+    filename, line, name = function
+    return f'{os.path.basename(filename)}:{line}({name})' if line else name
+
+
+def collapse(stats, min_us=10, max_depth=64):
+    """Return collapsed stacks -> microseconds from the pstats call graph.
+
+    cProfile only records caller -> callee edges, so the time of a function
+    reached along several paths is split over them in proportion to the
+    time of each call edge. The number of paths grows exponentially with
+    the depth of the graph, so a call taking less than min_us on a path, or
+    deeper than max_depth, is not split further but kept as one frame with
+    its cumulative time.
+    """
+    entries = stats.stats
+    callees = defaultdict(dict)
+    for function, (_, _, _, _, callers) in entries.items():
+        for caller, edge in callers.items():
+            callees[caller][function] = edge
+    stacks = defaultdict(float)
+
+    def walk(function, stack, share):
+        _, _, tt, ct, _ = entries[function]
+        stack = stack + [label(function)]
+        if ct * share * 1e6 < min_us or len(stack) >= max_depth:
+            stacks[';'.join(stack)] += ct * share
+            return
+        stacks[';'.join(stack)] += tt * share
+        for callee, (_, _, _, edge_ct) in callees[function].items():
+            if label(callee) not in stack and ct:
+                walk(callee, stack, share * edge_ct / entries[callee][3]
+                     if entries[callee][3] else 0)
+
+    for function, (_, _, _, _, callers) in entries.items():
+        if not callers:
+            walk(function, [], 1.0)
+    return {stack: round(seconds * 1e6) for stack, seconds in stacks.items()
+            if seconds * 1e6 >= 1}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('paths', nargs='+', help='.pstats files or directories')
+    parser.add_argument('--collapsed', help='write collapsed stacks to this file')
+    parser.add_argument('--top', type=int, default=25)
+    parser.add_argument('--min-us', type=float, default=10,
+                        help='calls shorter than this on a stack are not split')
+    parser.add_argument('--max-depth', type=int, default=64)
+    side = parser.add_mutually_exclusive_group()
+    side.add_argument('--connection', action='store_true', default=None,
+                      help='only the persistent connection profiles')
+    side.add_argument('--tasks', action='store_false', dest='connection',
+                      help='only the task profiles')
+    args = parser.parse_args()
+
+    stats, n = load(args.paths, args.connection)
+    print(f'{n} profiles merged')
+    stats.sort_stats('cumulative').print_stats(args.top)
+    if args.collapsed:
+        stacks = collapse(stats, args.min_us, args.max_depth)
+        with open(args.collapsed, 'w') as f:
+            for stack, microseconds in sorted(stacks.items()):
+                f.write(f'{stack} {microseconds}\n')
+        print(f'{len(stacks)} stacks written to {args.collapsed}')
@@ -0,0 +1,206 @@
+"""File: psm_bench.py
+
+Offline benchmark of PSM custom hardware layers, before openplc_hardware
+pushes them to a PLC.
+
+Imports the layer (a list of files is concatenated, like custom_layer_code)
+against a simulated psm module whose inputs change every cycle, then runs
+hardware_init() and N cycles of update_inputs() and update_outputs(). It
+reports CPU and wall time per cycle, memory allocated per cycle and the
+achievable scan rate, and exits 1 when the p99 cycle takes more than the
+budget share of the layer's PERIOD.
+
+    python benchmarks/psm_bench.py playbooks/hardware/assets/psm_io.py \\
+        playbooks/hardware/assets/custom_layer.py --cycles 5000
+"""
+import argparse
+import contextlib
+import importlib.util
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PERIOD = 0.1
+
+
+def load_psm_io():
+    """Import psm_io.py of the hardware assets, for its LocalPSM."""
+    path = os.path.join(ROOT, 'playbooks', 'hardware', 'assets', 'psm_io.py')
+    spec = importlib.util.spec_from_file_location('psm_io', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class SimulatedPSM(load_psm_io().LocalPSM):
+    """LocalPSM whose inputs change between reads.
+
+    Args:
+        change (float): chance that a location read with get_var changed
+            since the previous read.
+        call_cost (float): seconds every get_var/set_var busy waits, the
+            round trip to OpenPLC on the PLC.
+        seed (int): seed of the simulated IO.
+    """
+
+    def __init__(self, change=0.1, call_cost=0.0, seed=0):
+        super().__init__(call_cost=call_cost)
+        self.change = change
+        self.random = random.Random(seed)
+        self.started = False
+
+    def start(self):
+        self.started = True
+
+    def get_var(self, location):
+        value = super().get_var(location)
+        if self.random.random() < self.change:
+            value = (not value) if 'X' in location else self.random.randrange(1 << 16)
+            self.values[location] = value
+        return value
+
+    def module(self):
+        """Return this simulation as a module named psm."""
+        module = types.ModuleType('psm')
+        for name in ['start', 'stop', 'should_quit', 'get_var', 'set_var']:
+            setattr(module, name, getattr(self, name))
+        return module
+
+
+class Lines:
+    """Stdout that only counts the lines written to it."""
+
+    def __init__(self):
+        self.count = 0
+
+    def write(self, text):
+        self.count += text.count('\n')
+
+    def flush(self):
+        pass
+
+
+def load_layer(filenames, simulation):
+    """Import the concatenated layer files with psm simulated."""
+    code = []
+    for filename in filenames:
+        with open(filename, 'r') as f:
+            code.append(f.read())
+    code = '\n'.join(code)
+    previous = {name: sys.modules.pop(name, None) for name in ['psm', 'psm_io']}
+    sys.modules['psm'] = simulation.module()
+    # A layer without psm_io.py in front imports it from its own directory,
+    # fresh, so it binds this simulation.
+    sys.path.insert(0, os.path.dirname(os.path.abspath(filenames[-1])))
+    try:
+        layer = types.ModuleType('custom_layer')
+        exec(compile(code, filenames[-1], 'exec'), layer.__dict__)
+    finally:
+        del sys.path[0]
+        for name, module in previous.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+    for name in ['hardware_init', 'update_inputs', 'update_outputs']:
+        if not callable(getattr(layer, name, None)):
+            raise SystemExit(f'{filenames} has no {name}()')
+    return layer
+
+
+def cycle_times(layer, cycles):
+    """Return CPU and wall seconds of every cycle."""
+    cpu, wall = [], []
+    for _ in range(cycles):
+        start_cpu, start = time.thread_time(), time.perf_counter()
+        layer.update_inputs()
+        layer.update_outputs()
+        wall.append(time.perf_counter() - start)
+        cpu.append(time.thread_time() - start_cpu)
+    return cpu, wall
+
+
+def cycle_allocations(layer, cycles):
+    """Return peak bytes allocated per cycle and bytes still held after."""
+    # Allocated up front, so the list itself is not counted as held.
+    peaks = [0] * cycles
+    tracemalloc.start()
+    try:
+        held = tracemalloc.get_traced_memory()[0]
+        for i in range(cycles):
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            layer.update_inputs()
+            layer.update_outputs()
+            peaks[i] = tracemalloc.get_traced_memory()[1] - current
+        return peaks, tracemalloc.get_traced_memory()[0] - held
+    finally:
+        tracemalloc.stop()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def benchmark(filenames, cycles=1000, change=0.1, call_cost=0.0, seed=0,
+              period=None):
+    """Return the statistics of running the layer for cycles cycles."""
+    simulation = SimulatedPSM(change=change, call_cost=call_cost, seed=seed)
+    layer = load_layer(filenames, simulation)
+    output = Lines()
+    # The dashboard shows what the layer prints, keep it out of the report.
+    with contextlib.redirect_stdout(output):
+        layer.hardware_init()
+        cycle_times(layer, min(cycles, 100))  # warm up
+        simulation.calls, output.count = 0, 0
+        cpu, wall = cycle_times(layer, cycles)
+        calls, lines = simulation.calls, output.count
+        peaks, held = cycle_allocations(layer, min(cycles, 1000))
+    period = period or getattr(layer, 'PERIOD', PERIOD)
+    p99 = percentile(wall, 99)
+    return dict(cycles=cycles, period=period, started=simulation.started,
+                cpu_mean=statistics.fmean(cpu), cpu_p99=percentile(cpu, 99),
+                wall_mean=statistics.fmean(wall), wall_p99=p99,
+                wall_max=max(wall), scan_rate=1 / p99 if p99 else float('inf'),
+                psm_calls=calls / cycles, printed=lines / cycles,
+                alloc_mean=statistics.fmean(peaks), alloc_max=max(peaks),
+                held=held)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('files', nargs='+', help='layer files, concatenated in order')
+    parser.add_argument('--cycles', type=int, default=1000)
+    parser.add_argument('--change', type=float, default=0.1,
+                        help='chance an input changed since the last read')
+    parser.add_argument('--call-cost', type=float, default=0.0,
+                        help='seconds per psm call, e.g. 2e-5')
+    parser.add_argument('--period', type=float,
+                        help='cycle period, defaults to PERIOD of the layer')
+    parser.add_argument('--budget', type=float, default=0.5,
+                        help='share of the period the p99 cycle may take')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    r = benchmark(args.files, args.cycles, args.change, args.call_cost,
+                  args.seed, args.period)
+    print(f"{r['cycles']} cycles, period {r['period'] * 1000:.1f} ms")
+    print(f"cpu    mean {r['cpu_mean'] * 1e6:10.1f} us  p99 {r['cpu_p99'] * 1e6:10.1f} us")
+    print(f"wall   mean {r['wall_mean'] * 1e6:10.1f} us  p99 {r['wall_p99'] * 1e6:10.1f} us"
+          f"  max {r['wall_max'] * 1e6:10.1f} us")
+    print(f"alloc  mean {r['alloc_mean']:10.0f} B   max {r['alloc_max']:10.0f} B"
+          f"  held after {r['held']} B")
+    print(f"{r['psm_calls']:.1f} psm calls and {r['printed']:.2f} lines printed per cycle")
+    print(f"achievable scan rate {r['scan_rate']:.0f} Hz (p99)")
+    if not r['started']:
+        print('warning: hardware_init() did not call psm.start()')
+    if r['wall_p99'] > args.budget * r['period']:
+        print(f"FAIL p99 cycle {r['wall_p99'] * 1000:.3f} ms exceeds "
+              f"{args.budget:.0%} of {r['period'] * 1000:.1f} ms", file=sys.stderr)
+        sys.exit(1)
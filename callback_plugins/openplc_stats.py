@@ -0,0 +1,112 @@
+"""File: openplc_stats.py
+
+Callback plugin summing the openplc_stats of all openplc_* tasks.
+
+At the end of the play it prints, per host and per module, the number of
+requests, the bytes sent and received, the time spent in requests, login,
+parsing, compilation and runtime downtime, and the slowest endpoints. Enable it with
+ANSIBLE_CALLBACKS_ENABLED=openplc_stats (callback_whitelist on older Ansible).
+"""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = """
+    name: openplc_stats
+    type: aggregate
+    short_description: Sums request counts and timings of openplc_* tasks.
+    description:
+      - Adds up the openplc_stats returned by the openplc_* modules per host
+        and per module and prints them at the end of the playbook.
+    requirements:
+      - enable in configuration
+    options:
+      output:
+        description: Also write the totals as JSON to this file.
+        default: null
+        ini:
+          - section: callback_openplc_stats
+            key: output
+        env:
+          - name: OPENPLC_STATS_OUTPUT
+      endpoints:
+        description: Number of slowest endpoints shown per host.
+        type: integer
+        default: 5
+        ini:
+          - section: callback_openplc_stats
+            key: endpoints
+        env:
+          - name: OPENPLC_STATS_ENDPOINTS
+"""
+
+import json
+from collections import defaultdict
+
+from ansible.plugins.callback import CallbackBase
+
+# Totals shown in the summary, in this order.
+COUNTERS = ['tasks', 'requests', 'bytes_out', 'bytes_in', 'seconds', 'login',
+            'parse', 'compile_wait', 'downtime']
+
+
+def _totals():
+    """Return empty totals with per-endpoint counters."""
+    totals = dict.fromkeys(COUNTERS, 0)
+    totals['endpoints'] = defaultdict(lambda: dict(requests=0, seconds=0.0,
+                                                   bytes_in=0))
+    return totals
+
+
+def _add(totals, stats):
+    """Add the openplc_stats of one task to totals."""
+    totals['tasks'] += 1
+    for counter in COUNTERS[1:]:
+        totals[counter] += stats.get(counter, 0)
+    for name, endpoint in stats.get('endpoints', {}).items():
+        for counter, value in endpoint.items():
+            totals['endpoints'][name][counter] += value
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'openplc_stats'
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+        self.hosts = defaultdict(_totals)
+        self.modules = defaultdict(_totals)
+
+    def v2_runner_on_ok(self, result):
+        stats = result._result.get('openplc_stats')
+        if not stats:
+            return
+        _add(self.hosts[result._host.get_name()], stats)
+        _add(self.modules[result._task.action], stats)
+
+    def _table(self, title, rows):
+        """Display totals per host or module as a table."""
+        self._display.banner(f'OPENPLC STATS PER {title}')
+        self._display.display(f"{'':<24}" + ''.join(f'{c:>13}' for c in COUNTERS))
+        for name, totals in sorted(rows.items()):
+            self._display.display(f'{name:<24}' + ''.join(
+                f'{totals[c]:>13.3f}' if isinstance(totals[c], float)
+                else f'{totals[c]:>13}' for c in COUNTERS))
+
+    def v2_playbook_on_stats(self, stats):
+        if not self.hosts:
+            return
+        self._table('HOST', self.hosts)
+        self._table('MODULE', self.modules)
+        top = self.get_option('endpoints')
+        for host, totals in sorted(self.hosts.items()):
+            slowest = sorted(totals['endpoints'].items(),
+                             key=lambda e: e[1]['seconds'], reverse=True)[:top]
+            self._display.display(f'{host} slowest endpoints: ' + ', '.join(
+                f"{name} {e['seconds']:.3f}s/{e['requests']}" for name, e in slowest))
+        output = self.get_option('output')
+        if output:
+            with open(output, 'w') as f:
+                json.dump(dict(hosts=self.hosts, modules=self.modules), f, indent=2)
@@ -0,0 +1,619 @@
+"""File: openplc.py
+
+Persistent connection plugin for the OpenPLCv3 webserver.
+
+Like the httpapi connection, the plugin logs in once and keeps the
+authenticated HTTP session (and its TCP connections) alive in
+ansible-connection for the whole play. The openplc_* ActionModules send all
+their traffic through request(). Set ansible_connection=openplc for a host to
+use it; otherwise the ActionModules create a non-persistent instance per task.
+
+Session cookies are also kept in an on-disk cache, so separate
+ansible-playbook processes reuse a login after one cheap validity probe.
+
+GET responses are kept in a page cache until the next POST or state-changing
+GET, so a task fetching the same listing twice costs one round trip.
+
+Every request is counted and timed per endpoint; stats() returns the numbers
+since the last reset_stats(), the ActionModules put them in openplc_stats.
+"""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = """
+    author: RP1 NHP6 & MBWhitestone
+    name: openplc
+    short_description: Persistent HTTP session with an OpenPLCv3 webserver
+    description:
+      - Logs in to the OpenPLCv3 webserver once per host and reuses the
+        authenticated session for every openplc_* task in the play.
+    options:
+      host:
+        description: Address of the OpenPLC webserver.
+        default: inventory_hostname
+        vars:
+          - name: inventory_hostname
+          - name: ansible_host
+      http_port:
+        type: int
+        description: Port of the OpenPLC webserver.
+        default: 8080
+        vars:
+          - name: http_port
+      username:
+        description: OpenPLC user to log in with.
+        vars:
+          - name: username
+      password:
+        description: Password of the OpenPLC user.
+        vars:
+          - name: password
+      session_cache:
+        description:
+          - File caching the session cookie per host, port and user.
+          - Shared between processes, access is guarded by a file lock.
+        default: ~/.ansible/openplc/sessions.json
+        env:
+          - name: OPENPLC_SESSION_CACHE
+        vars:
+          - name: openplc_session_cache
+      cache_dir:
+        description: Directory of the local caches of cache_get() and cache_set().
+        default: ~/.ansible/openplc
+        env:
+          - name: OPENPLC_CACHE_DIR
+        vars:
+          - name: openplc_cache_dir
+      session_cache_ttl:
+        type: int
+        description: Seconds a cached session cookie is used, 0 disables the cache.
+        default: 1800
+        env:
+          - name: OPENPLC_SESSION_CACHE_TTL
+        vars:
+          - name: openplc_session_cache_ttl
+      request_timeout:
+        type: int
+        description: Seconds to wait for a single HTTP request.
+        default: 30
+        vars:
+          - name: openplc_request_timeout
+      persistent_connect_timeout:
+        type: int
+        description: Seconds to wait for the persistent connection to start.
+        default: 30
+        ini:
+          - section: persistent_connection
+            key: connect_timeout
+        env:
+          - name: ANSIBLE_PERSISTENT_CONNECT_TIMEOUT
+        vars:
+          - name: ansible_connect_timeout
+      persistent_command_timeout:
+        type: int
+        description: Seconds to wait for a single call on the connection.
+        default: 30
+        ini:
+          - section: persistent_connection
+            key: command_timeout
+        env:
+          - name: ANSIBLE_PERSISTENT_COMMAND_TIMEOUT
+        vars:
+          - name: ansible_command_timeout
+      persistent_log_messages:
+        type: boolean
+        description: Log the messages of the persistent connection.
+        default: False
+        ini:
+          - section: persistent_connection
+            key: log_messages
+        env:
+          - name: ANSIBLE_PERSISTENT_LOG_MESSAGES
+        vars:
+          - name: ansible_persistent_log_messages
+"""
+
+import cProfile
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+# Common error handlers
+from ansible.errors import AnsibleConnectionFailure
+# Base class for connections living in ansible-connection
+from ansible.plugins.connection import NetworkConnectionBase, ensure_connect
+
+LOGIN = 'login'
+# Small page that redirects to the login page without a valid session.
+PROBE = 'runtime_logs'
+# Pages that change over time without us changing anything.
+UNCACHED = ('compilation-logs', 'runtime_logs', 'dashboard')
+# GETs that change the PLC state and invalidate the page cache.
+STATE_CHANGING = ('delete-', 'remove-program', 'start_plc', 'stop_plc',
+                  'compile-program')
+# Listing tables: every row links to its item with table_id=<id>'.
+TABLE_ROW = re.compile("<tr(?P<attrs>[^>]*)>(?P<body>.*?)</tr>", re.DOTALL)
+TABLE_ID = re.compile("table_id=(?P<id>[^']*)'")
+TABLE_CELL = re.compile("<td>(?P<cell>.*?)</td>")
+MALFORMED_HTML = 200
+# Bytes of an uploaded file in memory at once.
+UPLOAD_CHUNK = 64 * 1024
+# Form fields: inputs, dropdowns, textareas and the device page script tail.
+FORM_FIELD = re.compile("<input (?P<input>.*?)>"
+                        "|<select(?P<select>[^>]*)>(?P<options>.*?)</select>"
+                        "|<textarea (?P<textarea>.*?)>(?P<content>.*?)</textarea>"
+                        "|(?P<script>;devid.value.*?;})", re.DOTALL)
+FORM_ATTRIBUTE = re.compile("(?P<key>[\\w-]+)="
+                            """(?:'(?P<single>[^']*)'|"(?P<double>[^"]*)")""")
+FORM_OPTION = re.compile("<option (?P<option>[^>]*)>")
+
+
+def parse_table(text):
+    """Parse all table rows of a listing page in one pass.
+
+    The first row is the header. Every other row needs a table_id link and
+    at least one <td></td> cell, otherwise it is reported as malformed.
+
+    Args:
+        text (str): HTML of the listing page.
+
+    Returns:
+        tuple: rows as dicts with id and cells, malformed rows as dicts with
+            their row number and (the start of) their html.
+    """
+    rows, malformed = [], []
+    matches = TABLE_ROW.finditer(text)
+    next(matches, None)
+    for number, row in enumerate(matches, 1):
+        attrs, body = row.group('attrs', 'body')
+        link = TABLE_ID.search(attrs) or TABLE_ID.search(body)
+        cells = TABLE_CELL.findall(body)
+        if link is None or not cells:
+            malformed.append(dict(row=number, html=row.group()[:MALFORMED_HTML]))
+        else:
+            rows.append(dict(id=link.group('id'), cells=cells))
+    return rows, malformed
+
+
+def _body_length(body):
+    """Return the size in bytes of a prepared request body."""
+    if body is None:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode())
+    # bytes or a MultipartStream.
+    return len(body)
+
+
+def _attributes(tag):
+    """Return the quoted attributes of a tag and its bare ones (e.g. checked)."""
+    attributes = {m.group('key'): m.group('single') if m.group('single') is not None
+                  else m.group('double') for m in FORM_ATTRIBUTE.finditer(tag)}
+    return attributes, FORM_ATTRIBUTE.sub('', tag).split()
+
+
+def parse_form(text):
+    """Parse every form field of a page in one pass.
+
+    Args:
+        text (str): HTML of an edit or settings page.
+
+    Returns:
+        dict: inputs (name -> value), checked (ids of checked inputs),
+            selected (dropdown name -> value of the selected option),
+            textareas (name -> content) and script (device property -> value
+            set by the script at the bottom of the device page).
+    """
+    form = dict(inputs={}, checked=[], selected={}, textareas={}, script={})
+    for field in FORM_FIELD.finditer(text):
+        kind = field.lastgroup
+        if kind == 'input':
+            attributes, bare = _attributes(field.group('input'))
+            if 'name' in attributes and 'value' in attributes:
+                form['inputs'][attributes['name']] = attributes['value']
+            if 'checked' in attributes or 'checked' in bare:
+                form['checked'].append(attributes.get('id', ''))
+        elif kind == 'options':
+            attributes, _ = _attributes(field.group('select'))
+            name = attributes.get('name', attributes.get('id', ''))
+            for option in FORM_OPTION.finditer(field.group('options')):
+                option, _ = _attributes(option.group('option'))
+                if option.get('selected') == 'selected' and 'value' in option:
+                    form['selected'][name] = option['value']
+                    break
+        elif kind == 'content':
+            attributes, _ = _attributes(field.group('textarea'))
+            if 'name' in attributes:
+                form['textareas'][attributes['name']] = field.group('content')
+        elif kind == 'script':
+            for statement in field.group('script').split(';'):
+                if '=' in statement:
+                    attr, val = statement.split(' = ')
+                    form['script'][attr[:-6].replace('dev', 'device_').replace(
+                        'start', '_start').replace('size', '_size')] = val[1:-1]
+    return form
+
+
+class MultipartStream:
+    """multipart/form-data body streaming its files from disk.
+
+    requests sends an iterable with a length as is, with a Content-Length
+    header, so only one chunk of a file is in memory at a time. Each
+    iteration opens and closes the files again, so redirects can resend it.
+    """
+
+    def __init__(self, fields, files, chunk=UPLOAD_CHUNK):
+        """Prepare the parts.
+
+        Args:
+            fields (dict): form fields, None values are left out.
+            files (dict): field -> [filename, path, mimetype].
+            chunk (int, optional): bytes read at once. Defaults to UPLOAD_CHUNK.
+        """
+        self.boundary = uuid.uuid4().hex
+        self.chunk = chunk
+        self.parts = []
+        for name, value in (fields or {}).items():
+            if value is not None:
+                self.parts.append((self._header(name), None,
+                                   str(value).encode('utf-8')))
+        for name, (filename, path, mime) in files.items():
+            self.parts.append((self._header(name, filename, mime), path, b''))
+        self.end = f'--{self.boundary}--\r\n'.encode('utf-8')
+        self.length = len(self.end) + sum(
+            len(head) + len(value) + len(b'\r\n') +
+            (os.path.getsize(path) if path else 0)
+            for head, path, value in self.parts)
+
+    @property
+    def content_type(self):
+        """Return the Content-Type header value with the boundary."""
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def _header(self, name, filename=None, mime=None):
+        """Return the boundary and headers in front of a part."""
+        disposition = f'form-data; name="{name}"'
+        if filename is not None:
+            filename = filename.replace('"', '%22')
+            disposition += f'; filename="{filename}"'
+        header = f'--{self.boundary}\r\nContent-Disposition: {disposition}\r\n'
+        if mime:
+            header += f'Content-Type: {mime}\r\n'
+        return (header + '\r\n').encode('utf-8')
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for head, path, value in self.parts:
+            yield head
+            if path:
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(self.chunk), b''):
+                        yield chunk
+            else:
+                yield value
+            yield b'\r\n'
+        yield self.end
+
+
+class JsonCache:
+    """JSON file of expiring entries shared by several processes."""
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    @contextmanager
+    def _locked(self, operation):
+        """Hold a lock on the cache, shared for reading, exclusive for writing."""
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read(self):
+        """Return all entries, an unreadable cache is an empty cache."""
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, entries):
+        """Atomically replace the cache, readable for the owner only."""
+        tmp = f'{self.path}.{os.getpid()}'
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                               0o600), 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp, self.path)
+
+    def get(self, key):
+        """Return the value of key or None when missing or expired."""
+        with self._locked(fcntl.LOCK_SH):
+            entry = self._read().get(key)
+        if entry is None or entry['expires'] < time.time():
+            return None
+        return entry['value']
+
+    def set(self, key, value, ttl):
+        """Store value for ttl seconds, dropping expired entries."""
+        now = time.time()
+        with self._locked(fcntl.LOCK_EX):
+            entries = {k: e for k, e in self._read().items()
+                       if e['expires'] >= now}
+            entries[key] = dict(value=value, expires=now + ttl)
+            self._write(entries)
+
+    def delete(self, key):
+        """Remove key from the cache."""
+        with self._locked(fcntl.LOCK_EX):
+            entries = self._read()
+            if entries.pop(key, None) is not None:
+                self._write(entries)
+
+
+class Connection(NetworkConnectionBase):
+    """Authenticated HTTP session with one OpenPLC webserver."""
+
+    transport = 'openplc'
+    has_pipelining = True
+
+    def __init__(self, play_context, new_stdin, *args, **kwargs):
+        super(Connection, self).__init__(play_context, new_stdin, *args, **kwargs)
+        self.session = None
+        self.url = None
+        # Guards the page cache, get_forms() uses the session from threads.
+        self._lock = threading.Lock()
+        self.clear_cache()
+        self.reset_stats()
+        self._profiler = None
+
+    def _connect(self):
+        """Setup TCP session with PLC and log in."""
+        if not self.connected:
+            start = time.perf_counter()
+            host, port = self.get_option('host'), self.get_option('http_port')
+            self.url = f'http://{host}:{port}/'
+            self.session = requests.session()
+            if not self._restore_session():
+                self._login()
+                self._store_session()
+            self._connected = True
+            self._stats['login'] += time.perf_counter() - start
+
+    def _session_key(self):
+        """Return the session cache key of this host, port and user."""
+        host, port = self.get_option('host'), self.get_option('http_port')
+        return f"{host}:{port}:{self.get_option('username')}"
+
+    def _restore_session(self, probe=PROBE):
+        """Reuse a cached session cookie if one GET shows it is still valid."""
+        if not self.get_option('session_cache_ttl'):
+            return False
+        cache = JsonCache(self.get_option('session_cache'))
+        cookies = cache.get(self._session_key())
+        if not cookies:
+            return False
+        self.session.cookies.update(cookies)
+        try:
+            info = self.session.get(self.url + probe, allow_redirects=False,
+                                    timeout=self.get_option('request_timeout'))
+        except requests.RequestException:
+            info = None
+        if info is not None and info.status_code == 200:
+            self.queue_message('vvvv', f'Reusing cached session on {self.url}')
+            return True
+        self.session.cookies.clear()
+        cache.delete(self._session_key())
+        return False
+
+    def _store_session(self):
+        """Put the session cookie of a fresh login in the cache."""
+        ttl = self.get_option('session_cache_ttl')
+        if ttl:
+            JsonCache(self.get_option('session_cache')).set(
+                self._session_key(), self.session.cookies.get_dict(), ttl)
+
+    def _login(self, login=LOGIN):
+        """Log in, the session keeps the cookie."""
+        payload = {"username": self.get_option('username'),
+                   "password": self.get_option('password')}
+        info = self._request(login, 'POST', data=payload)
+        if info.status_code != 200:
+            raise AnsibleConnectionFailure(
+                f'Login on {self.url} failed with {info.status_code}')
+        self.queue_message('vvvv', f'Logged in on {self.url}')
+
+    def _request(self, path, method, data=None, files=None):
+        """Perform a single request relative to the webserver root."""
+        headers = None
+        if files:
+            # Stream the files from disk instead of reading them into memory.
+            data = MultipartStream(data, files)
+            headers = {'Content-Type': data.content_type}
+        try:
+            return self.session.request(
+                method, self.url + path, data=data, headers=headers,
+                timeout=self.get_option('request_timeout'))
+        except requests.RequestException as e:
+            raise AnsibleConnectionFailure(f'{method} {self.url}{path} failed: {e}')
+
+    @ensure_connect
+    def request(self, path, method='GET', data=None, files=None):
+        """Perform a request and return its status code and text.
+
+        Args:
+            path (str): page relative to the webserver root, e.g. 'users'.
+            method (str, optional): HTTP method. Defaults to 'GET'.
+            data (dict, optional): form fields. Defaults to None.
+            files (dict, optional): field -> [filename, path, mimetype].
+                Defaults to None.
+
+        Returns:
+            dict: status_code, text and url of the response.
+        """
+        cacheable = method == 'GET' and not path.startswith(UNCACHED)
+        with self._lock:
+            if cacheable and path in self._cache:
+                self._cache_hits += 1
+                return dict(self._cache[path])
+        start = time.perf_counter()
+        info = self._request(path, method, data=data, files=files)
+        # After a redirect info.request is the follow-up GET, the body sent
+        # is that of the first request.
+        sent = (info.history[0] if info.history else info).request.body
+        self._count(path, time.perf_counter() - start, _body_length(sent),
+                    len(info.content))
+        info = dict(status_code=info.status_code, text=info.text, url=info.url)
+        with self._lock:
+            if method != 'GET' or path.startswith(STATE_CHANGING):
+                self._cache.clear()
+            elif cacheable:
+                self._cache_misses += 1
+                if info['status_code'] == 200:
+                    self._cache[path] = dict(info)
+        return info
+
+    def clear_cache(self):
+        """Empty the page cache and reset its counters."""
+        self._cache = {}
+        self._cache_hits = self._cache_misses = 0
+
+    def reset_stats(self):
+        """Start counting requests, bytes and time from zero."""
+        self._stats = dict(requests=0, bytes_out=0, bytes_in=0, seconds=0.0,
+                           login=0.0, parse=0.0, endpoints={})
+
+    def _count(self, path, seconds, bytes_out, bytes_in):
+        """Add one request to the stats of its endpoint (path without query)."""
+        with self._lock:
+            stats = self._stats
+            endpoint = stats['endpoints'].setdefault(
+                path.split('?')[0], dict(requests=0, seconds=0.0, bytes_in=0))
+            for counter in (stats, endpoint):
+                counter['requests'] += 1
+                counter['seconds'] += seconds
+                counter['bytes_in'] += bytes_in
+            stats['bytes_out'] += bytes_out
+
+    def stats(self):
+        """Return requests, bytes, login, parse and time per endpoint.
+
+        Returns:
+            dict: requests, bytes_out, bytes_in and seconds of all requests,
+                login and parse seconds, and requests, seconds and bytes_in
+                per endpoint. Cached pages are not requests.
+        """
+        with self._lock:
+            return json.loads(json.dumps(self._stats))
+
+    def cache_stats(self):
+        """Return the hits and misses of the page cache."""
+        return dict(hits=self._cache_hits, misses=self._cache_misses,
+                    pages=len(self._cache))
+
+    @ensure_connect
+    def get_table(self, path):
+        """GET a listing page and parse its table.
+
+        Returns:
+            dict: the request() result plus the rows and malformed rows of
+                parse_table().
+        """
+        info = self.request(path)
+        start = time.perf_counter()
+        info['rows'], info['malformed'] = parse_table(info['text'])
+        # prefetch() parses in worker threads.
+        with self._lock:
+            self._stats['parse'] += time.perf_counter() - start
+        return info
+
+    @ensure_connect
+    def get_form(self, path):
+        """GET an edit or settings page and parse its form.
+
+        Returns:
+            dict: the request() result plus the form of parse_form().
+        """
+        info = self.request(path)
+        start = time.perf_counter()
+        info['form'] = parse_form(info['text'])
+        # prefetch() parses in worker threads.
+        with self._lock:
+            self._stats['parse'] += time.perf_counter() - start
+        return info
+
+    @ensure_connect
+    def prefetch(self, paths, workers=8):
+        """GET several pages concurrently into the page cache.
+
+        Later request(), get_table() or get_form() calls for these pages cost no
+        round trip.
+
+        Args:
+            paths (list): pages relative to the webserver root.
+            workers (int, optional): concurrent requests. Defaults to 8.
+
+        Returns:
+            dict: path -> status code.
+        """
+        if not paths:
+            return {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return {path: info['status_code']
+                    for path, info in zip(paths, pool.map(self.request, paths))}
+
+    def start_profile(self):
+        """Profile this process until stop_profile().
+
+        Used by ActionModules with OPENPLC_PROFILE set, because the work of a
+        persistent connection happens in ansible-connection, not in the task.
+        """
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+
+    def stop_profile(self, path):
+        """Stop profiling and write the pstats to path."""
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(path)
+            self._profiler = None
+
+    def cache_get(self, name, key):
+        """Return an entry of the local cache called name, or None.
+
+        Local caches are JSON files in cache_dir shared by all processes on
+        the controller. They need no PLC, so no login happens.
+        """
+        return JsonCache(self._cache_file(name)).get(key)
+
+    def cache_set(self, name, key, value, ttl):
+        """Store an entry in the local cache called name for ttl seconds."""
+        JsonCache(self._cache_file(name)).set(key, value, ttl)
+
+    def cache_delete(self, name, key):
+        """Remove an entry from the local cache called name."""
+        JsonCache(self._cache_file(name)).delete(key)
+
+    def _cache_file(self, name):
+        """Return the file of the local cache called name."""
+        return os.path.join(self.get_option('cache_dir'), f'{name}.json')
+
+    def close(self):
+        """Close the HTTP session."""
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+        self._connected = False
+        super(Connection, self).close()
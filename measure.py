@@ -1,46 +1,233 @@
 """File: measure.py
 
 This file contains code to measure the performance of the Ansible plugin.
+
+The openplc ActionModules are driven in-process, so a sample times the
+plugin and not the startup of ansible-playbook. Every sample is split in
+phases (login, listing, details, post, compile wait) and written as one JSON
+line. Session cookies are not cached and fingerprints are off, so every
+sample logs in and does all its requests. The overhead of Ansible itself is
+measured separately by running the same playbook, the same way, with
+ansible-playbook.
+
+Samples go to the SQLite store of results.py, tagged with run id, host,
+plugin, playbook, PLC state and git commit; --output also writes JSON lines.
+
+    python measure.py -i hosts --rounds 15 --warmup 2 --running
 """
+import argparse
+import csv
+import functools
+import json
+import os
 import subprocess
+import sys
+import time
+import uuid
 from collections import defaultdict
+
 import numpy as np
-import os
 import pickle
-import time
+import yaml
 
+from analyse import load, print_summary, summarise
+from results import STORE, ResultStore, git_commit
 
-def test(name):
-    """Test a single playbook."""
-    print('testing', name, end='... ', flush=True)
-    program = f"""- hosts: all
-  become: no
-  gather_facts: no
-  tasks:
-    - include_tasks: playbooks/measurements/{name}
-"""
-    with open('temp.yml', 'w') as f:
-        f.write(program)
-    run = '/usr/bin/time -f "%e" sudo ansible-playbook -vvv temp.yml -i hosts'
-    ret = subprocess.run(run, shell=True, capture_output=True)
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = os.path.join(ROOT, 'playbooks', 'measurements')
+TESTS = ['addclient.yml', 'modifyclient.yml', 'removeclient.yml',
+         'adduser.yml', 'modifyuser.yml', 'removeuser.yml',
+         'modifysettings.yml', 'resetsettings.yml',
+         'applyprogram.yml', 'removeprogram.yml',
+         'modifyhardware.yml', 'resethardware.yml']
+RUNNING = 'runplc.yml'
+# Phase -> ActionModule method, timed exclusive of nested phases.
+ACTION_PHASES = {'listing': '_get_known', 'details': '_details',
+                 'post': '_post', 'compile_wait': '_wait_compilation'}
+CONNECTION_PHASES = {'login': '_connect'}
+# ActionModules taking the fingerprint arg, the samples turn it off.
+FINGERPRINTED = ['openplc_user', 'openplc_users', 'openplc_device',
+                 'openplc_devices', 'openplc_settings', 'openplc_hardware',
+                 'openplc_file_upload']
+
+
+class Phases:
+    """Exclusive time per phase; time in a nested phase counts only there."""
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self._stack = []
+
+    def wrap(self, phase, function):
+        """Return function timed as phase."""
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            self._stack.append(0.0)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.totals[phase] += elapsed - self._stack.pop()
+                if self._stack:
+                    self._stack[-1] += elapsed
+        return timed
+
+
+class Harness:
+    """Runs the tasks of a playbook in-process against one inventory host."""
+
+    def __init__(self, inventory, host):
+        from ansible import context
+        from ansible.inventory.manager import InventoryManager
+        from ansible.module_utils.common.collections import ImmutableDict
+        from ansible.parsing.dataloader import DataLoader
+        from ansible.plugins import loader as plugin_loader
+        from ansible.vars.manager import VariableManager
+        if hasattr(plugin_loader, 'init_plugin_loader'):
+            plugin_loader.init_plugin_loader()
+        context.CLIARGS = ImmutableDict(context.CLIARGS or {})
+        plugin_loader.add_all_plugin_dirs(ROOT)
+        self.plugin_loader = plugin_loader
+        self.loader = DataLoader()
+        self.inventory = InventoryManager(loader=self.loader, sources=[inventory])
+        self.variables = VariableManager(loader=self.loader, inventory=self.inventory)
+        self.host = self.inventory.get_host(host)
+
+    def run_task(self, task_ds, phases):
+        """Run one task through its ActionModule and return its result."""
+        from ansible.playbook.play_context import PlayContext
+        from ansible.playbook.task import Task
+        from ansible.template import Templar
+        task = Task.load(task_ds, loader=self.loader, variable_manager=self.variables)
+        if task.action != 'openplc_facts':
+            # A sample must do the work, not skip it on a fingerprint.
+            task.args['fingerprint'] = 'off'
+        task_vars = self.variables.get_vars(host=self.host, task=task)
+        # No cached session cookie either, so every sample logs in.
+        task_vars['openplc_session_cache_ttl'] = 0
+        templar = Templar(loader=self.loader, variables=task_vars)
+        task.post_validate(templar=templar)
+        play_context = PlayContext()
+        # No persistent connection, the ActionModule opens its own session.
+        connection = self.plugin_loader.connection_loader.get(
+            'local', play_context, '/dev/null')
+        action = self.plugin_loader.action_loader.get(
+            task.action, task=task, connection=connection,
+            play_context=play_context, loader=self.loader, templar=templar,
+            shared_loader_obj=self.plugin_loader)
+        for phase, method in ACTION_PHASES.items():
+            if hasattr(action, method):
+                setattr(action, method, phases.wrap(phase, getattr(action, method)))
+        result = action.run(task_vars=task_vars)
+        if result.get('failed'):
+            raise RuntimeError(result.get('msg', result))
+        return result
+
+    def run_playbook(self, name):
+        """Run all tasks of a measurement playbook, timing every phase.
+
+        Returns:
+            dict: ok, seconds, phases and (when failed) error of the sample.
+        """
+        with open(os.path.join(SCENARIOS, name), 'r') as f:
+            tasks = yaml.safe_load(f)
+        phases = Phases()
+        connection = self.plugin_loader.connection_loader.get(
+            'openplc', class_only=True)
+        originals = {m: getattr(connection, m) for m in CONNECTION_PHASES.values()}
+        for phase, method in CONNECTION_PHASES.items():
+            setattr(connection, method, phases.wrap(phase, originals[method]))
+        sample = dict(ok=True, error=None, plugin=','.join(
+            sorted({k for task in tasks for k in task if k.startswith('openplc_')})))
+        start = time.perf_counter()
+        try:
+            for task_ds in tasks:
+                self.run_task(task_ds, phases)
+        except Exception as e:
+            sample.update(ok=False, error=f'{type(e).__name__}: {e}')
+        finally:
+            for method, original in originals.items():
+                setattr(connection, method, original)
+        sample['seconds'] = time.perf_counter() - start
+        sample['phases'] = dict(phases.totals)
+        sample['phases']['other'] = sample['seconds'] - sum(phases.totals.values())
+        return sample
+
+
+def ansible_overhead(name, inventory, host, inprocess):
+    """Return wall time of ansible-playbook for name minus in-process time.
+
+    Like the in-process samples: no fingerprints, no cached session cookie
+    and a connection of its own per task.
+    """
+    defaults = {m: dict(fingerprint='off') for m in FINGERPRINTED}
+    program = [dict(hosts=host, become=False, gather_facts=False,
+                    module_defaults=defaults,
+                    tasks=[{'include_tasks': os.path.join(SCENARIOS, name)}])]
+    playbook = os.path.join(ROOT, f'.measure_{uuid.uuid4().hex}.yml')
+    with open(playbook, 'w') as f:
+        yaml.safe_dump(program, f)
     try:
-        seconds = float(ret.stderr)
-    except:
-        seconds = -1
-        print(ret)
-    print(seconds)
-    return seconds
-
-
-def test_all(tests, n, running):
-    """Test multiple playbooks."""
-    results = defaultdict(list)
-    for _ in range(n):
+        start = time.perf_counter()
+        ret = subprocess.run(['ansible-playbook', playbook, '-i', inventory,
+                              '-e', 'openplc_session_cache_ttl=0',
+                              '-e', 'ansible_connection=local'],
+                             capture_output=True, cwd=ROOT)
+        seconds = time.perf_counter() - start
+    finally:
+        os.remove(playbook)
+    if ret.returncode != 0:
+        return None
+    return seconds - inprocess
+
+
+def test_all(harness, tests, n, running, warmup=0, store=None, output=None,
+             run_id=None):
+    """Test multiple playbooks in-process, n rounds after warmup rounds.
+
+    Returns:
+        list: one dict per sample, also appended to the store and to output
+            as JSON lines as soon as it is measured.
+    """
+    run_id = run_id or uuid.uuid4().hex[:12]
+    commit = git_commit()
+    samples = []
+    for r in range(-warmup, n):
         if running:
-            test('runplc.yml')
-        for l in tests:
-            results[l].append(test(name=l))
-    saveresults(results, n=n, running=running)
+            sample = harness.run_playbook(RUNNING)
+            if not sample['ok']:
+                # The samples of this round would be stored as running.
+                raise RuntimeError(f"{RUNNING} failed in round {r}, the PLC may "
+                                   f"not be running: {sample['error']}")
+        for name in tests:
+            print('testing', name, end='... ', flush=True)
+            sample = harness.run_playbook(name)
+            print(f"{sample['seconds']:.3f}" if sample['ok'] else sample['error'])
+            if r < 0:
+                continue
+            sample.update(run_id=run_id, host=harness.host.name, playbook=name,
+                          round=r, running=running, git_commit=commit,
+                          created=time.time())
+            samples.append(sample)
+            if store:
+                store.add([sample])
+            if output:
+                with open(output, 'a') as f:
+                    f.write(json.dumps(sample) + '\n')
+    return samples
+
+
+def write_csv(samples, filename):
+    """Write samples as CSV with one column per phase."""
+    phases = sorted({p for s in samples for p in s['phases']})
+    columns = ['run_id', 'host', 'playbook', 'round', 'running', 'ok',
+               'seconds'] + phases + ['error']
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        for s in samples:
+            writer.writerow({**{c: s.get(c) for c in columns}, **s['phases']})
 
 
 def saveresults(results, n, extra='', running=False):
@@ -58,56 +245,75 @@ def saveresults(results, n, extra='', running=False):
 
 
 def combineresults(files):
-    """Combine multiple results into one dictionary."""
+    """Combine multiple results of the same PLC state into one dictionary."""
     combined = defaultdict(list)
     leng = 0
+    states = {'notrunning' not in f for f in files}
+    assert len(states) == 1, "Do not combine running and not running results."
     for f in files:
         with open(f, 'rb') as handle:
             b = pickle.load(handle)
             for key, value in b.items():
                 combined[key] += value
-            leng += len(value)
-    runs = 'notrunning' not in f
-    saveresults(combined, n=leng, extra='_combined', running=runs)
+            # Rounds of this file, the longest list of one playbook.
+            leng += max(map(len, b.values()), default=0)
+    saveresults(combined, n=leng, extra='_combined', running=states.pop())
 
 
-def analyse(filename, decimals=2):
-    """Analyse a file with results."""
-    with open(filename, 'rb') as handle:
-        b = pickle.load(handle)
-    for key, value in b.items():
-        print(key, 'raw', value, 'μ', np.round(np.mean(value), decimals),
-              'σ', np.round(np.std(value), decimals))
+def analyse(filename):
+    """Analyse a file with results, see analyse.py."""
+    print_summary(summarise(load([filename])))
 
 
 if __name__ == '__main__':
-    # Make sure we have sudo
-    subprocess.run("sudo ls", shell=True, capture_output=True)
-    # Change this to the dicts to combine
-    # combinefiles = []
-    combinefiles = ['measurements_hostname_174620_15rounds_running.p']
-    # Change this to the dicts to analyse
-    analysefiles = ['measurements_hostname_174620_15rounds_running.p']
-    # Testrounds
-    N = 15
-    # Running PLC
-    RUNNING = True
-
-    if combinefiles:
-        combineresults(combinefiles)
-    else:
-        if RUNNING:
-                test('runplc.yml')
-        else:
-            y = input('Make sure nothing is running on PLC and type y')
-            assert y == 'y', "This is an insulting message."
-
-        test_all(['addclient.yml', 'modifyclient.yml', 'removeclient.yml',
-                  'adduser.yml', 'modifyuser.yml', 'removeuser.yml',
-                  'modifysettings.yml', 'resetsettings.yml',
-                  'applyprogram.yml', 'removeprogram.yml',
-                  'modifyhardware.yml', 'resethardware.yml',
-                  ], n=N, running=RUNNING)
-
-    for a in analysefiles:
-        analyse(a)
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('-i', '--inventory', default='hosts')
+    parser.add_argument('--host', default='openplc', help='inventory host')
+    parser.add_argument('--tests', nargs='+', default=TESTS)
+    parser.add_argument('--rounds', type=int, default=15)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--running', action='store_true',
+                        help=f'run {RUNNING} before every round')
+    parser.add_argument('--ansible-rounds', type=int, default=1,
+                        help='ansible-playbook runs per test for the overhead')
+    parser.add_argument('--store', default=STORE, help='SQLite results store')
+    parser.add_argument('--output', default=None, help='also write JSON lines')
+    parser.add_argument('--csv', default=None, help='also write a CSV file')
+    parser.add_argument('--combine', nargs='+', help='combine old pickle files')
+    parser.add_argument('--analyse', nargs='+', help='analyse old pickle files')
+    args = parser.parse_args()
+
+    if args.combine or args.analyse:
+        if args.combine:
+            combineresults(args.combine)
+        for a in args.analyse or []:
+            analyse(a)
+        sys.exit(0)
+
+    if not args.running:
+        y = input('Make sure nothing is running on PLC and type y')
+        assert y == 'y', "This is an insulting message."
+    harness = Harness(args.inventory, args.host)
+    store = ResultStore(args.store)
+    samples = test_all(harness, args.tests, n=args.rounds, running=args.running,
+                       warmup=args.warmup, store=store, output=args.output)
+    run_id = samples[0]['run_id'] if samples else None
+
+    # Ansible's own share, reported next to the in-process numbers.
+    for name in args.tests:
+        inprocess = np.median([s['seconds'] for s in samples
+                               if s['playbook'] == name and s['ok']] or [np.nan])
+        overhead = [ansible_overhead(name, args.inventory, args.host, inprocess)
+                    for _ in range(args.ansible_rounds)]
+        overhead = [o for o in overhead if o is not None]
+        print(f"{name:<20} in-process {inprocess:.3f}s, ansible overhead "
+              f"{np.median(overhead) if overhead else float('nan'):.3f}s")
+        # Without samples there is no run to attach the overhead to.
+        if run_id is not None:
+            store.add_overhead(run_id, name, float(inprocess), overhead)
+    if args.csv:
+        write_csv(samples, args.csv)
+    store.close()
+    print(f'run {run_id} stored in {args.store}')
+    failed = [s for s in samples if not s['ok']]
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,323 @@
+"""File: openplc_fleet.py
+
+Apply one declarative OpenPLCv3 configuration to many PLCs concurrently.
+
+Instead of one Ansible fork per PLC, a single asyncio process drives all
+PLCs, each with its own pooled HTTP client. The operations are the same as
+those of the openplc_* ActionModules (listing, details, add/modify/remove)
+and use the parsers of the openplc connection plugin, so besides httpx it
+needs what that plugin imports: ansible and requests.
+
+    python openplc_fleet.py fleet.yml -i hosts --concurrency 50
+
+Example fleet.yml:
+
+    users:
+      - user_name: operator1
+        properties: {full_name: Operator One, user_password: secret}
+    devices:
+      - device_name: Temp device
+        properties: {device_protocol: TCP, device_id: "688"}
+    settings: {slave_polling_period: 100, dnp3_server_port: false}
+    hardware: {hardware_layer: blank_linux}
+    purge: {users: false, devices: false}
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import sys
+import time
+
+import yaml
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+LOGIN = 'login'
+# Same pages and columns as openplc_users.py and openplc_devices.py.
+KINDS = {
+    'users': dict(name='user_name', add='add-user', edit='edit-user',
+                  rm='delete-user?user_id=', info='users', column=1,
+                  selected='', missing=['file'],
+                  required=['user_name', 'user_password']),
+    'devices': dict(name='device_name', add='add-modbus-device',
+                    edit='modbus-edit-device', rm='delete-device?dev_id=',
+                    info='modbus', column=0, selected='device_protocol',
+                    missing=[], required=['device_name', 'device_id']),
+}
+SETTINGS = 'settings'
+SETTINGS_REQUIRED = ['slave_polling_period', 'slave_timeout', 'auto_run_text']
+HARDWARE = 'hardware'
+HARDWARE_SELECTED = 'hardware_layer'
+
+
+def load_parsers():
+    """Import parse_table() and parse_form() from the connection plugin."""
+    path = os.path.join(ROOT, 'connection_plugins', 'openplc.py')
+    spec = importlib.util.spec_from_file_location('openplc_connection', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.parse_table, module.parse_form
+
+
+def read_inventory(filename):
+    """Return the hosts of an inventory like `hosts` as name -> vars.
+
+    Parsed by Ansible itself, so groups, [group:vars], [group:children] and
+    group_vars/host_vars apply as they would to a play.
+    """
+    from ansible.inventory.manager import InventoryManager
+    from ansible.parsing.dataloader import DataLoader
+    from ansible.vars.manager import VariableManager
+    loader = DataLoader()
+    inventory = InventoryManager(loader=loader, sources=[filename])
+    variables = VariableManager(loader=loader, inventory=inventory)
+    return {host.name: variables.get_vars(host=host, include_hostvars=False)
+            for host in inventory.get_hosts()}
+
+
+class FleetError(Exception):
+    """An OpenPLC webserver returned something unexpected."""
+
+
+class AsyncPLC:
+    """One OpenPLC webserver behind an asyncio HTTP client."""
+
+    def __init__(self, name, hostvars, parsers, connections=4, timeout=30):
+        self.name = name
+        self.vars = hostvars
+        self.parse_table, self.parse_form = parsers
+        host = hostvars.get('ansible_host', name)
+        self.client = httpx.AsyncClient(
+            base_url=f"http://{host}:{hostvars['http_port']}/",
+            limits=httpx.Limits(max_connections=connections),
+            timeout=timeout)
+        self.requests = 0
+        # Reads are concurrent, but OpenPLC gets one write at a time.
+        self.writing = asyncio.Lock()
+
+    async def close(self):
+        """Close all pooled connections."""
+        await self.client.aclose()
+
+    def _check_info(self, info, url, succes=200, error_len=300):
+        """Validate a response."""
+        if info.status_code != succes:
+            raise FleetError(f'Status code for {url} not {succes}; {info.text}')
+        if 'error' and 'database' in info.text[-error_len:].lower():
+            raise FleetError(f'{url}: {info.text[-error_len:]}')
+        return info
+
+    async def _get(self, url):
+        """Perform GET request."""
+        self.requests += 1
+        return self._check_info(
+            await self.client.get(url, follow_redirects=True), url)
+
+    async def _post(self, url, data, file_key='file'):
+        """Perform POST request."""
+        self.requests += 1
+        data = dict(data)
+        files = None
+        if data.get(file_key):
+            filename = data.pop(file_key)
+            with open(filename, 'rb') as f:
+                files = {'file': (filename, f.read(),
+                                  f"image/{filename.split('.')[-1]}")}
+        data.pop(file_key, None)
+        async with self.writing:
+            return self._check_info(await self.client.post(
+                url, data=data, files=files, follow_redirects=True), url)
+
+    async def login(self):
+        """Log in, the client keeps the session cookie."""
+        await self._post(LOGIN, data={"username": self.vars['username'],
+                                      "password": self.vars['password']})
+
+    async def get_known(self, page, column):
+        """Return column entry -> table ID of the listing on page."""
+        rows, _ = self.parse_table((await self._get(page)).text)
+        return {row['cells'][column]: row['id'] for row in rows
+                if len(row['cells']) > column}
+
+    async def details(self, page, selected='', missing=()):
+        """Return the properties and form of an edit page, like _details()."""
+        form = self.parse_form((await self._get(page)).text)
+        properties = {**form['script'], **form['inputs'], **form['textareas']}
+        if selected:
+            properties[selected] = form['selected'].get(
+                selected, list(form['selected'].values())[0])
+        for m in missing:
+            properties[m] = ''
+        return properties, form
+
+    async def modify(self, page, details, properties):
+        """Post details updated with properties when something changed."""
+        changed = False
+        for p, value in properties.items():
+            if p not in details:
+                raise FleetError(f"{p} is not a valid property.")
+            if details[p] != str(value):
+                details[p] = str(value)
+                changed = True
+        if changed:
+            await self._post(page, data=details)
+        return changed
+
+    async def reconcile(self, kind, desired, purge=False):
+        """Bring the users or devices table in line with desired."""
+        k = KINDS[kind]
+        known = await self.get_known(k['info'], k['column'])
+        report = dict(added=[], modified=[], removed=[], unchanged=[])
+
+        async def present(item):
+            name, properties = item[k['name']], item.get('properties', {})
+            if name in known:
+                page = f"{k['edit']}?table_id={known[name]}"
+                details, _ = await self.details(page, k['selected'], k['missing'])
+                changed = await self.modify(k['edit'], details, properties)
+                report['modified' if changed else 'unchanged'].append(name)
+            else:
+                data = {**properties, k['name']: name}
+                for required in k['required']:
+                    if required not in data:
+                        raise FleetError(f"Missing {required} property for {name}.")
+                await self._post(k['add'], data=data)
+                report['added'].append(name)
+
+        async def absent(name):
+            # Removing is a GET, but a write all the same.
+            async with self.writing:
+                await self._get(k['rm'] + known[name])
+            report['removed'].append(name)
+
+        listed = {item[k['name']] for item in desired}
+        jobs = [present(item) for item in desired
+                if item.get('state', 'present') == 'present']
+        jobs += [absent(item[k['name']]) for item in desired
+                 if item.get('state', 'present') == 'absent'
+                 and item[k['name']] in known]
+        if purge:
+            jobs += [absent(name) for name in known if name not in listed]
+        await asyncio.gather(*jobs)
+
+        if report['added']:
+            new_items = await self.get_known(k['info'], k['column'])
+            missing = [name for name in report['added'] if name not in new_items]
+            if missing:
+                raise FleetError(f"{missing} not in {new_items}")
+        return report
+
+    async def settings(self, properties, page=SETTINGS):
+        """Apply settings like openplc_settings._add()."""
+        details, form = await self.details(page)
+        checked = [[name for name in details.keys() if input_id in name][0]
+                   for input_id in form['checked']]
+        current_details = {k: details[k] for k in SETTINGS_REQUIRED + checked}
+        changed = False
+        for p, value in properties.items():
+            if p not in details:
+                raise FleetError(f"{p} is not a valid property.")
+            value = str(value).lower()
+            if value in ['false', 'none']:
+                if p in current_details:
+                    del current_details[p]
+                    changed = True
+            elif details[p] != value or p not in current_details:
+                current_details[p] = value
+                changed = True
+        if changed:
+            await self._post(page, data=current_details)
+        return changed
+
+    async def hardware(self, properties, page=HARDWARE):
+        """Apply the hardware layer like openplc_hardware._add()."""
+        details, _ = await self.details(page, HARDWARE_SELECTED)
+        properties = dict(properties)
+        for k in details.keys():
+            if 'code' in k and k in properties:
+                # A list of files is concatenated, like openplc_hardware.
+                files = properties[k]
+                code = []
+                for filename in [files] if isinstance(files, str) else files:
+                    with open(filename, 'r') as f:
+                        code.append(f.read())
+                properties[k] = '\n'.join(code)
+        return await self.modify(page, details, properties)
+
+    async def apply(self, config):
+        """Apply the whole configuration, returning what changed."""
+        result = dict()
+        await self.login()
+        purge = config.get('purge', {})
+        for kind in KINDS:
+            if kind in config:
+                result[kind] = await self.reconcile(
+                    kind, config[kind], purge=purge.get(kind, False))
+        if SETTINGS in config:
+            result[SETTINGS] = await self.settings(config[SETTINGS])
+        if HARDWARE in config:
+            result[HARDWARE] = await self.hardware(config[HARDWARE])
+        return result
+
+
+async def apply_fleet(hosts, config, concurrency=50, connections=4, timeout=30):
+    """Apply config to all hosts, at most concurrency hosts at a time.
+
+    Returns:
+        dict: host -> dict with ok, seconds, requests and result or error.
+    """
+    parsers = load_parsers()
+    limit = asyncio.Semaphore(concurrency)
+
+    async def one(name, hostvars):
+        async with limit:
+            plc, start = None, time.perf_counter()
+            # Any failure is reported for this host only, the others go on.
+            try:
+                plc = AsyncPLC(name, hostvars, parsers, connections, timeout)
+                outcome = dict(ok=True, result=await plc.apply(config))
+            except Exception as e:
+                outcome = dict(ok=False, error=f'{type(e).__name__}: {e}')
+            finally:
+                if plc is not None:
+                    await plc.close()
+            outcome.update(seconds=time.perf_counter() - start,
+                           requests=plc.requests if plc is not None else 0)
+            return name, outcome
+
+    return dict(await asyncio.gather(*[one(n, v) for n, v in hosts.items()]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('config', help='declarative configuration (YAML)')
+    parser.add_argument('-i', '--inventory', default='hosts')
+    parser.add_argument('--limit', nargs='*', help='only these hosts')
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help='PLCs configured at the same time')
+    parser.add_argument('--connections', type=int, default=4,
+                        help='HTTP connections per PLC')
+    parser.add_argument('--timeout', type=float, default=30)
+    args = parser.parse_args()
+    if httpx is None:
+        sys.exit('openplc_fleet.py needs httpx: pip install httpx')
+
+    with open(args.config, 'r') as f:
+        config = yaml.safe_load(f)
+    hosts = read_inventory(args.inventory)
+    if args.limit:
+        hosts = {n: v for n, v in hosts.items() if n in args.limit}
+    start = time.perf_counter()
+    results = asyncio.run(apply_fleet(hosts, config, args.concurrency,
+                                      args.connections, args.timeout))
+    print(json.dumps(results, indent=2))
+    failed = [n for n, r in results.items() if not r['ok']]
+    print(f'{len(hosts)} PLCs in {time.perf_counter() - start:.1f}s, '
+          f'{len(failed)} failed {failed}', file=sys.stderr)
+    sys.exit(1 if failed else 0)
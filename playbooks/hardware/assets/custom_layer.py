@@ -22,14 +22,40 @@
 # first digital input (%IX0.0) every second. Also, if the first digital
 # output (%QX0.0) is true, PSM will display "QX0.0 is true" on OpenPLC's
 # dashboard. Feel free to reuse this skeleton to write whatever you want.
+#
+# The cycle runs on a deadline: every cycle starts PERIOD seconds after the
+# previous one was due, however long the IO work took. A cycle that is not
+# done by the next deadline is an overrun, the missed cycles are skipped
+# instead of run back to back. How late every cycle started (its jitter) is
+# kept for the last HISTORY cycles and reported every REPORT_EVERY cycles.
+#
+# The IO goes through the PSMImage of psm_io.py, which openplc_hardware
+# deploys in front of this file: all locations are read in one pass and only
+# changed ones are written. Run on its own, this file imports psm_io.py from
+# its directory instead.
 
 #import all your libraries here
-import psm
+import os
 import time
+from array import array
+
+import psm
+
+try:
+    PSMImage
+except NameError:
+    from psm_io import PSMImage
+
+#cycle time in seconds, set PSM_PERIOD to change it
+PERIOD = float(os.environ.get('PSM_PERIOD', 0.1))
+HISTORY = 1000
+REPORT_EVERY = 100
 
 #global variables
 counter = 0
 var_state = False
+#locations this layer reads and writes, see psm_io.py
+io = PSMImage(read=["QX0.0"], write=["IX0.0"])
 
 def hardware_init():
     #Insert your hardware initialization code in here
@@ -39,7 +65,8 @@ def update_inputs():
     #place here your code to update inputs
     global counter
     global var_state
-    psm.set_var("IX0.0", var_state)
+    io["IX0.0"] = var_state
+    io.flush()
     counter += 1
     if (counter == 10):
         counter = 0
@@ -47,18 +74,59 @@ def update_inputs():
 
 def update_outputs():
     #place here your code to work on outputs
-    a = psm.get_var("QX0.0")
-    if a == True:
+    io.update()
+    if io["QX0.0"]:
         print("QX0.0 is true")
 
 
-if __name__ == "__main__":
-    hardware_init()
-    print('Ansible rocks!')
-    while (not psm.should_quit()):
+class CycleStats:
+    """Jitter of the last cycles in a ring buffer, plus overruns."""
+
+    def __init__(self, size=HISTORY):
+        self.jitter = array('d', [0.0] * size)
+        self.size = size
+        self.cycles = 0
+        self.overruns = 0
+        self.busy = 0.0
+
+    def add(self, jitter, busy):
+        """Record how late a cycle started and how long its IO took."""
+        self.jitter[self.cycles % self.size] = jitter
+        self.cycles += 1
+        self.busy = max(self.busy, busy)
+
+    def report(self):
+        """Return min/mean/p99/max jitter in ms of the buffered cycles."""
+        samples = sorted(self.jitter[:min(self.cycles, self.size)])
+        p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+        return (f'PSM {self.cycles} cycles of {PERIOD * 1000:.1f} ms, jitter '
+                f'min {samples[0] * 1000:.3f} mean {sum(samples) / len(samples) * 1000:.3f} '
+                f'p99 {p99 * 1000:.3f} max {samples[-1] * 1000:.3f} ms, '
+                f'longest cycle {self.busy * 1000:.3f} ms, {self.overruns} overruns')
+
+
+def run(period=PERIOD, report_every=REPORT_EVERY):
+    """Run update_inputs() and update_outputs() every period seconds."""
+    stats = CycleStats()
+    deadline = time.monotonic()
+    while not psm.should_quit():
+        start = time.monotonic()
         update_inputs()
         update_outputs()
-        time.sleep(0.1) #You can adjust the psm cycle time here
-    psm.stop()
+        now = time.monotonic()
+        stats.add(start - deadline, now - start)
+        deadline += period
+        if now > deadline:
+            # Overrun, continue at the next deadline still ahead.
+            stats.overruns += 1
+            deadline += ((now - deadline) // period + 1) * period
+        if stats.cycles % report_every == 0:
+            print(stats.report())
+        time.sleep(max(0.0, deadline - time.monotonic()))
 
 
+if __name__ == "__main__":
+    hardware_init()
+    print('Ansible rocks!')
+    run()
+    psm.stop()
@@ -0,0 +1,154 @@
+#                  - Batched IO for OpenPLC Python SubModules (PSM) -
+#
+# Calling psm.get_var() and psm.set_var() for every location every cycle
+# costs a call into OpenPLC even when nothing changed. PSMImage declares the
+# locations once, reads all of them in one pass per cycle into an array and
+# only writes back the locations whose value changed since the last write.
+#
+# Deploy it in front of your layer, openplc_hardware concatenates a list:
+#     custom_layer_code: [playbooks/hardware/assets/psm_io.py, my_layer.py]
+# and use it in the layer:
+#     io = PSMImage(read=["QX0.0", "QW0"], write=["IX0.0", "IW0"])
+#     def update_inputs():
+#         io["IX0.0"] = sensor()
+#         io.flush()
+#     def update_outputs():
+#         io.update()
+#         motor(io["QX0.0"])
+#
+# Off the PLC there is no psm module, LocalPSM stands in for it so the cost
+# per cycle can be measured with benchmark():
+#     python -c "import psm_io; print(psm_io.benchmark())"
+import time
+from array import array
+
+try:
+    import psm
+except ImportError:
+    psm = None
+
+
+class LocalPSM:
+    """In memory stand-in of the psm module, counting the calls made.
+
+    Args:
+        cycles (int, optional): should_quit() after this many cycles.
+        call_cost (float, optional): seconds every get/set_var busy waits,
+            like the round trip to OpenPLC does on the PLC. Defaults to 0.
+    """
+
+    def __init__(self, cycles=None, call_cost=0.0):
+        self.values = {}
+        self.calls = 0
+        self.cycles = cycles
+        self.call_cost = call_cost
+
+    def _call(self):
+        self.calls += 1
+        if self.call_cost:
+            end = time.perf_counter() + self.call_cost
+            while time.perf_counter() < end:
+                pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def should_quit(self):
+        if self.cycles is None:
+            return False
+        self.cycles -= 1
+        return self.cycles < 0
+
+    def get_var(self, location):
+        self._call()
+        return self.values.get(location, False if 'X' in location else 0)
+
+    def set_var(self, location, value):
+        self._call()
+        self.values[location] = value
+
+
+class PSMImage:
+    """Process image of PSM locations.
+
+    Args:
+        read (list): locations read with update(), e.g. "QX0.0" or "QW0".
+        write (list): locations written with flush(), e.g. "IX0.0".
+        module (optional): psm module or LocalPSM. Defaults to psm.
+    """
+
+    def __init__(self, read=(), write=(), module=None):
+        self.psm = module or psm
+        self.read = list(read)
+        self.write = list(write)
+        self.slots = {location: i for i, location in enumerate(self.read)}
+        self.slots.update((location, len(self.read) + i)
+                          for i, location in enumerate(self.write))
+        # Bit locations (%IX, %QX) are bools, the others integers.
+        self.bits = [('X' in location) for location in self.read + self.write]
+        self.values = array('q', [0] * len(self.slots))
+        self.written = array('q', [0] * len(self.write))
+        self.synced = False
+
+    def update(self):
+        """Read all read locations from OpenPLC."""
+        get_var, values = self.psm.get_var, self.values
+        for i, location in enumerate(self.read):
+            values[i] = int(get_var(location) or 0)
+
+    def flush(self):
+        """Write the write locations that changed, return how many."""
+        set_var, values, written = self.psm.set_var, self.values, self.written
+        offset, count = len(self.read), 0
+        for i, location in enumerate(self.write):
+            value = values[offset + i]
+            if self.synced and value == written[i]:
+                continue
+            set_var(location, bool(value) if self.bits[offset + i] else value)
+            written[i] = value
+            count += 1
+        self.synced = True
+        return count
+
+    def __getitem__(self, location):
+        i = self.slots[location]
+        return bool(self.values[i]) if self.bits[i] else self.values[i]
+
+    def __setitem__(self, location, value):
+        self.values[self.slots[location]] = int(value)
+
+
+def benchmark(locations=32, cycles=1000, changes=2, call_cost=20e-6):
+    """Return seconds and psm calls per cycle, per location vs PSMImage.
+
+    Every cycle reads locations outputs, sets locations inputs and changes
+    changes of them, on a LocalPSM whose calls cost call_cost seconds.
+    """
+    read = [f"QX{i // 8}.{i % 8}" for i in range(locations)]
+    write = [f"IX{i // 8}.{i % 8}" for i in range(locations)]
+    results = {}
+
+    local = LocalPSM(call_cost=call_cost)
+    start = time.perf_counter()
+    for cycle in range(cycles):
+        for location in read:
+            local.get_var(location)
+        for i, location in enumerate(write):
+            local.set_var(location, i < changes and cycle % 2 == 1)
+    results['per_location'] = ((time.perf_counter() - start) / cycles,
+                               local.calls / cycles)
+
+    local = LocalPSM(call_cost=call_cost)
+    io = PSMImage(read, write, module=local)
+    start = time.perf_counter()
+    for cycle in range(cycles):
+        io.update()
+        for i, location in enumerate(write[:changes]):
+            io[location] = cycle % 2 == 1
+        io.flush()
+    results['image'] = ((time.perf_counter() - start) / cycles,
+                        local.calls / cycles)
+    return results
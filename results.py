@@ -0,0 +1,185 @@
+"""File: results.py
+
+Append-only SQLite store for the results of measure.py.
+
+Every sample is one row, indexed by run id, host, plugin, playbook, PLC
+state and git commit, so analyse.py can query a slice without loading
+everything. Old pickles of measure.py can be imported.
+
+    python results.py import measurements_hostname_174620_15rounds_running.p
+    python results.py runs
+"""
+import argparse
+import json
+import os
+import pickle
+import sqlite3
+import subprocess
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STORE = 'measurements.sqlite'
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    id INTEGER PRIMARY KEY,
+    run_id TEXT NOT NULL,
+    host TEXT,
+    plugin TEXT,
+    playbook TEXT NOT NULL,
+    running INTEGER NOT NULL,
+    git_commit TEXT,
+    round INTEGER,
+    ok INTEGER NOT NULL,
+    seconds REAL,
+    phases TEXT,
+    error TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_run ON samples (run_id);
+CREATE INDEX IF NOT EXISTS samples_slice
+    ON samples (playbook, running, host, plugin, git_commit);
+CREATE TABLE IF NOT EXISTS overhead (
+    run_id TEXT NOT NULL,
+    playbook TEXT NOT NULL,
+    inprocess REAL,
+    overhead TEXT
+);
+"""
+# Columns that query() can filter on.
+INDEXED = ['run_id', 'host', 'plugin', 'playbook', 'running', 'git_commit']
+
+
+def git_commit(root=ROOT):
+    """Return the current commit of the repository, marked when dirty."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root,
+                                capture_output=True, check=True).stdout.decode().strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                               cwd=root, capture_output=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+
+class ResultStore:
+    """Samples of measure.py in a SQLite database."""
+
+    def __init__(self, path=STORE):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def add(self, samples):
+        """Append samples (dicts as made by measure.py)."""
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO samples (run_id, host, plugin, playbook, running, "
+                "git_commit, round, ok, seconds, phases, error, created) VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(s['run_id'], s.get('host'), s.get('plugin'), s['playbook'],
+                  int(s['running']), s.get('git_commit'), s.get('round'), int(s['ok']),
+                  s.get('seconds') if s['ok'] else None,
+                  json.dumps(s.get('phases', {})), s.get('error'),
+                  s.get('created', time.time())) for s in samples])
+
+    def add_overhead(self, run_id, playbook, inprocess, overhead):
+        """Append the ansible-playbook overhead measured for a playbook."""
+        with self.db:
+            self.db.execute("INSERT INTO overhead VALUES (?, ?, ?, ?)",
+                            (run_id, playbook, inprocess, json.dumps(overhead)))
+
+    def query(self, **filters):
+        """Return the samples matching all filters, oldest first.
+
+        Args:
+            **filters: column in INDEXED -> value or list of values.
+
+        Returns:
+            list: samples as dicts like measure.py makes them.
+        """
+        where, values = self._where(filters)
+        samples = []
+        for row in self.db.execute(f'SELECT * FROM samples{where} ORDER BY id',
+                                   values):
+            sample = dict(row)
+            sample.update(running=bool(sample['running']), ok=bool(sample['ok']),
+                          phases=json.loads(sample['phases'] or '{}'))
+            samples.append(sample)
+        return samples
+
+    def runs(self, **filters):
+        """Return one summary row per run with samples matching all filters.
+
+        Args:
+            **filters: like query(), the rows only count matching samples.
+        """
+        where, values = self._where(filters)
+        return [dict(row) for row in self.db.execute(
+            "SELECT run_id, host, git_commit, running, COUNT(*) AS samples, "
+            f"SUM(1 - ok) AS failures, MIN(created) AS started FROM samples{where} "
+            "GROUP BY run_id ORDER BY started", values)]
+
+    @staticmethod
+    def _where(filters):
+        """Return the WHERE clause of filters and its parameters."""
+        where, values = [], []
+        for column, value in filters.items():
+            if column not in INDEXED:
+                raise ValueError(f'Cannot filter on {column}, only on {INDEXED}.')
+            if value is None:
+                continue
+            value = value if isinstance(value, (list, tuple)) else [value]
+            where.append(f"{column} IN ({', '.join('?' * len(value))})")
+            values += [int(v) if column == 'running' else v for v in value]
+        return (' WHERE ' + ' AND '.join(where) if where else ''), values
+
+    def import_pickle(self, filename):
+        """Import an old measure.py pickle as one run.
+
+        Host, PLC state and time come from the file name,
+        measurements_<host>_<HHMMSS>_<n>rounds_<state>[_combined].p, failed
+        runs (-1) become failed samples.
+        """
+        name = os.path.basename(filename)
+        parts = name[:-2].split('_')
+        host = '_'.join(parts[1:-4 if name.endswith('_combined.p') else -3])
+        running = 'notrunning' not in name
+        with open(filename, 'rb') as handle:
+            results = pickle.load(handle)
+        run_id = f'pickle-{uuid.uuid4().hex[:8]}'
+        created = os.path.getmtime(filename)
+        self.add([dict(run_id=run_id, host=host or None, playbook=playbook,
+                       running=running, round=r, ok=seconds >= 0, seconds=seconds,
+                       error=None if seconds >= 0 else 'failed (legacy -1)',
+                       created=created)
+                  for playbook, values in results.items()
+                  for r, seconds in enumerate(values)])
+        return run_id
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--store', default=STORE)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('import', help='import old pickles').add_argument(
+        'files', nargs='+')
+    commands.add_parser('runs', help='list the runs in the store')
+    args = parser.parse_args()
+
+    store = ResultStore(args.store)
+    if args.command == 'import':
+        for f in args.files:
+            print(f, '->', store.import_pickle(f))
+    else:
+        for run in store.runs():
+            started = time.strftime('%Y-%m-%d %H:%M', time.localtime(run['started']))
+            state = 'running' if run['running'] else 'notrunning'
+            print(f"{run['run_id']:<18}{started:<18}{run['host'] or '-':<16}"
+                  f"{run['git_commit'] or '-':<14}{state:<12}"
+                  f"{run['samples']:>6} samples {run['failures']:>4} failed")
+    store.close()